@@ -0,0 +1,53 @@
+'''
+Benchmark of the analytics report
+
+Runs analyze() over synthetic questions generated chunk by chunk
+(about 1% are near-duplicates of an earlier question) and reports the
+time, the rows per second and the duplicates found.
+
+Run from the backend directory:
+  python -m benchmarks.bench_analytics --rows 1000000
+'''
+import argparse
+import random
+import time
+
+from flaskr.analytics import analyze, CHUNK_SIZE
+
+
+WORDS = ['what', 'which', 'who', 'title', 'tallest', 'mountain', 'river', 'painting', 'world', 'cup',
+         'science', 'history', 'movie', 'actor', 'country', 'capital', 'planet', 'element', 'author', 'year']
+VOCABULARY = ['{}{}'.format(word, number) for number in range(50) for word in WORDS]
+
+
+def question_text(question_id):
+  # Same id, same text (so the candidates can be loaded again)
+  rng = random.Random(question_id)
+  if question_id > 100 and rng.random() < 0.01:
+    # Near-duplicate of an earlier question: one more word at the end
+    return question_text(rng.randint(1, question_id - 1)) + ' ' + rng.choice(VOCABULARY)
+  return ' '.join(rng.choice(VOCABULARY) for _ in range(rng.randint(8, 16))) + '?'
+
+
+def chunks(rows, chunk_size):
+  for start in range(1, rows + 1, chunk_size):
+    yield [(question_id, question_id % 6 + 1, question_id % 5 + 1, question_text(question_id), 'answer')
+           for question_id in range(start, min(start + chunk_size, rows + 1))]
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--rows', type=int, default=1000000)
+  parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+  args = parser.parse_args()
+
+  generated = list(chunks(args.rows, args.chunk_size))
+  start = time.perf_counter()
+  report = analyze(generated, lambda ids: {question_id: question_text(question_id) for question_id in ids})
+  seconds = time.perf_counter() - start
+  print('{} rows in {:.2f} s ({:.0f} rows/s)'.format(args.rows, seconds, args.rows / seconds))
+  print('{} candidate pairs, {} duplicate groups'.format(report['duplicate_candidates'], len(report['duplicates'])))
+
+
+if __name__ == '__main__':
+  main()
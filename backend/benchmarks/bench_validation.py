@@ -0,0 +1,55 @@
+'''
+Benchmark of the request validation layer
+
+Measures the compiled validators alone and the per-request overhead
+of validate_json through the Flask test client (no database needed).
+
+Run from the backend directory:
+  python -m benchmarks.bench_validation
+'''
+import timeit
+from flask import Flask, jsonify, g
+
+from flaskr import QUESTION_SCHEMA, QUIZ_SCHEMA
+from flaskr.validation import compile_schema, validate_json
+
+
+N = 20000
+
+VALID_QUESTION = {'question': ' Who invented Peanut Butter? ', 'answer': 'George Washington Carver', 'category': '4', 'difficulty': 2}
+INVALID_QUESTION = {'question': '', 'category': 'Geography', 'difficulty': 9}
+VALID_QUIZ = {'previous_questions': list(range(50)), 'quiz_category': {'type': 'Art', 'id': 2}}
+
+
+def bench(label, stmt, number=N):
+  seconds = min(timeit.repeat(stmt, number=number, repeat=3))
+  print('{:<40} {:>8.2f} us/call'.format(label, seconds / number * 1e6))
+
+
+def main():
+  validate_question = compile_schema(QUESTION_SCHEMA)
+  validate_quiz = compile_schema(QUIZ_SCHEMA)
+  bench('validator: valid question', lambda: validate_question(VALID_QUESTION))
+  bench('validator: invalid question', lambda: validate_question(INVALID_QUESTION))
+  bench('validator: quiz (50 previous ids)', lambda: validate_quiz(VALID_QUIZ))
+
+  # Same view with and without the decorator to isolate its cost per request
+  app = Flask(__name__)
+
+  @app.route('/raw', methods=['POST'])
+  def raw():
+    return jsonify({'success': True})
+
+  @app.route('/validated', methods=['POST'])
+  @validate_json(QUESTION_SCHEMA)
+  def validated():
+    return jsonify({'success': True, 'body': g.body})
+
+  client = app.test_client()
+  bench('request: no validation', lambda: client.post('/raw', json=VALID_QUESTION), N // 10)
+  bench('request: validate_json, valid body', lambda: client.post('/validated', json=VALID_QUESTION), N // 10)
+  bench('request: validate_json, rejected (400)', lambda: client.post('/validated', json=INVALID_QUESTION), N // 10)
+
+
+if __name__ == '__main__':
+  main()
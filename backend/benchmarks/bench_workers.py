@@ -0,0 +1,85 @@
+'''
+Benchmark of throughput scaling across worker processes
+
+Starts gunicorn (gunicorn.conf.py) with 1, 2, 4 ... workers up to the
+number of cores, sends requests from concurrent clients for a few
+seconds and reports requests per second. Needs the trivia database.
+
+Run from the backend directory:
+  python -m benchmarks.bench_workers --path /categories --seconds 10
+'''
+import argparse
+import multiprocessing
+import os
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+from urllib.error import URLError
+
+
+def wait_ready(url, timeout=30):
+  deadline = time.monotonic() + timeout
+  while time.monotonic() < deadline:
+    try:
+      urllib.request.urlopen(url).read()
+      return
+    except (URLError, ConnectionError):
+      time.sleep(0.2)
+  raise RuntimeError('server not ready: {}'.format(url))
+
+
+def load(url, seconds, clients):
+  counts = [0] * clients
+  errors = [0] * clients
+  deadline = time.monotonic() + seconds
+
+  def client(number):
+    while time.monotonic() < deadline:
+      try:
+        urllib.request.urlopen(url).read()
+        counts[number] += 1
+      except (URLError, ConnectionError):
+        errors[number] += 1
+
+  threads = [threading.Thread(target=client, args=(number,)) for number in range(clients)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  return sum(counts) / seconds, sum(errors)
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--path', default='/categories')
+  parser.add_argument('--seconds', type=float, default=10)
+  parser.add_argument('--clients', type=int, default=32)
+  parser.add_argument('--threads', type=int, default=1)
+  parser.add_argument('--port', type=int, default=5055)
+  args = parser.parse_args()
+
+  cores = multiprocessing.cpu_count()
+  worker_counts = sorted({count for count in (1, 2, 4, 8, 16, 32) if count <= cores} | {cores})
+  url = 'http://127.0.0.1:{}{}'.format(args.port, args.path)
+  baseline = None
+
+  for workers in worker_counts:
+    environ = dict(os.environ, WEB_CONCURRENCY=str(workers), THREADS=str(args.threads),
+                   BIND='127.0.0.1:{}'.format(args.port))
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py'],
+                              env=environ, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+      wait_ready(url)
+      throughput, errors = load(url, args.seconds, args.clients)
+    finally:
+      server.terminate()
+      server.wait()
+    baseline = baseline or throughput
+    print('{:>3} workers x {} threads: {:>9.1f} req/s ({:.2f}x, {} errors)'.format(
+      workers, args.threads, throughput, throughput / baseline, errors))
+
+
+if __name__ == '__main__':
+  main()
@@ -1,14 +1,36 @@
 import os
-from flask import Flask, request, abort, jsonify
+import json
+import time
+import threading
+import click
+from flask import Flask, request, abort, jsonify, g
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
+from sqlalchemy import func, tuple_, literal, null
+from sqlalchemy.exc import SQLAlchemyError
 import random
 
-from models import setup_db, Question, Category
+from models import db, setup_db, Question, QuestionTombstone, Category, UNRATED_DIFFICULTY
+from .validation import Field, validate_json, validate_args, INTEGER_PATTERN
+from .suggest import get_index
+from .cache import get_cache
+from .profiling import init_profiling, token_matches
+from .tenancy import init_tenancy, namespace
+from .analytics import question_bank_report, CHUNK_SIZE, DUPLICATE_THRESHOLD
 
 
 # Constant to paginate by 10 questions per page
 QUESTIONS_PER_PAGE = 10
+# Default and maximum number of changes per call of the change feed
+CHANGES_LIMIT = 100
+MAX_CHANGES_LIMIT = 1000
+# Seconds the analytics report is reused by GET /analytics
+ANALYTICS_CACHE_SECONDS = 300
+# Header of the admin token of GET /analytics (app.config['ANALYTICS_TOKEN'])
+ANALYTICS_TOKEN_HEADER = 'X-Analytics-Token'
+# Default and maximum number of suggestions for search-as-you-type
+SUGGESTIONS_LIMIT = 10
+MAX_SUGGESTIONS_LIMIT = 20
 
 '''
 Helper function
@@ -46,10 +68,90 @@ def paginate_questions(request, selection):
 
 
 
+'''
+Request body schemas
+validated before any database work (see validation.py)
+'''
+QUESTION_SCHEMA = {
+  'question': Field(str),
+  'answer': Field(str),
+  'category': Field(int, min_value=1),
+  'difficulty': Field(int, min_value=1, max_value=5)
+}
+
+SEARCH_SCHEMA = {
+  'searchTerm': Field(str, allow_empty=True, max_length=200)
+}
+
+CATEGORY_QUESTIONS_SCHEMA = {
+  'page': Field(int, required=False, default=1, min_value=1),
+  'sort': Field(str, required=False, default='id', choices=('id', 'difficulty')),
+  'order': Field(str, required=False, default='asc', choices=('asc', 'desc', 'random')),
+  'seed': Field(str, required=False, max_length=64),
+  'after': Field(str, required=False, max_length=64)
+}
+
+SUGGEST_SCHEMA = {
+  'q': Field(str, required=False, default='', allow_empty=True, max_length=200),
+  'limit': Field(int, required=False, default=SUGGESTIONS_LIMIT, min_value=1, max_value=MAX_SUGGESTIONS_LIMIT)
+}
+
+CHANGES_SCHEMA = {
+  'since': Field(int, required=False, default=0, min_value=0),
+  'limit': Field(int, required=False, default=CHANGES_LIMIT, min_value=1, max_value=MAX_CHANGES_LIMIT)
+}
+
+QUIZ_SCHEMA = {
+  'previous_questions': Field(list, items=int, allow_empty=True),
+  'quiz_category': Field(dict, schema={
+    'id': Field(int, min_value=0),
+    'type': Field(str, required=False, allow_empty=True)
+  })
+}
+
+
+
+'''
+Helper function
+keyset pagination of the questions per category
+'''
+def parse_cursor(after, sort):
+  """
+  Parse the `after` cursor of the questions per category
+
+  Parameters:
+  ----------
+  after: str
+    `<id>` when sorted by id, `<difficulty>:<id>` when sorted by difficulty
+    (UNRATED_DIFFICULTY for a question without difficulty)
+  sort: str
+    the sort column (id or difficulty)
+
+  Returns:
+  -------
+  values: tuple
+    the sort values of the last question of the previous page,
+    None if the cursor is not valid
+  """
+  parts = after.split(':')
+  if len(parts) != (1 if sort == 'id' else 2) or not all(INTEGER_PATTERN.match(part) for part in parts):
+    return None
+  return tuple(int(part) for part in parts)
+
+
+
 def create_app(test_config=None):
   # create and configure the app
   app = Flask(__name__)
+  if test_config is not None:
+    app.config.from_mapping(test_config)
   setup_db(app)
+  # Per-tenant databases and caches (off unless TENANT_DATABASE_PATH is set)
+  init_tenancy(app)
+  # On-demand profiling (off unless PROFILE_TOKEN or PROFILE_SAMPLE_RATE is set)
+  init_profiling(app)
+  # GET /analytics is off unless ANALYTICS_TOKEN is set
+  app.config.setdefault('ANALYTICS_TOKEN', os.environ.get('ANALYTICS_TOKEN'))
   
   '''
   Set up CORS. 
@@ -90,9 +192,8 @@ def create_app(test_config=None):
     ------
     404 error if there is no categories
     """
-    categories = Category.query.order_by(Category.id).all()
-    # Format categories dict
-    formatted_categories = {category.id: category.type for category in categories}
+    # Categories dict (cached)
+    formatted_categories = get_cache().get_categories()
     # Error 404 if there is no categories
     if len(formatted_categories) == 0:
       abort(404)
@@ -100,7 +201,7 @@ def create_app(test_config=None):
     return jsonify({
       'success': True,
       'categories': formatted_categories,
-      'total_categories': len(categories)
+      'total_categories': len(formatted_categories)
     })
 
 
@@ -129,10 +230,8 @@ def create_app(test_config=None):
     # Current questions per pag
     current_questions = paginate_questions(request, selection)
 
-    # Get all categories
-    categories = Category.query.order_by(Category.id).all()
-    # Format categories dict
-    formatted_categories = {category.id: category.type for category in categories}
+    # Categories dict (cached)
+    formatted_categories = get_cache().get_categories()
     
     # Error 404 if there is no questions
     if len(current_questions) == 0:
@@ -141,13 +240,73 @@ def create_app(test_config=None):
     return jsonify({
       'success': True,
       'questions': current_questions,
-      'total_questions': len(Question.query.all()),
+      'total_questions': len(selection),
       'categories': formatted_categories,
       'current_category': None
     })
 
   
 
+  '''
+  Endpoint to synchronize the question bank.
+  It returns the questions created, updated or deleted
+  since a token (the version of the last change seen),
+  so the sync cost depends on the changes, not the bank size.
+  '''
+  @app.route('/questions/changes')
+  @validate_args(CHANGES_SCHEMA)
+  def retrieve_question_changes():
+    """
+    Retrieve the changes of the questions since a token, ordered by version
+
+    Returns:
+    -------
+    JSON object includes a list of changes (the question, or deleted = True),
+    the token of the next call and if there are more changes
+
+    Raises:
+    ------
+    400 error if since or limit are not valid
+    """
+    since = g.args['since']
+    limit = g.args['limit']
+
+    # Both tables in one statement (one snapshot): with two SELECTs a change
+    # committed between them could be skipped by the next token.
+    # limit + 1 rows to know if there are more changes
+    changed = db.session.query(Question.version.label('version'), Question.id.label('id'),
+                               literal(False).label('deleted'), Question.question.label('question'),
+                               Question.answer.label('answer'), Question.category.label('category'),
+                               Question.difficulty.label('difficulty')) \
+      .filter(Question.version > since)
+    deleted = db.session.query(QuestionTombstone.version, QuestionTombstone.question_id,
+                               literal(True), null(), null(), null(), null()) \
+      .filter(QuestionTombstone.version > since)
+    rows = changed.union_all(deleted).order_by(Question.version).limit(limit + 1).all()
+
+    changes = []
+    for row in rows[:limit]:
+      change = {'id': row.id, 'version': row.version, 'deleted': row.deleted}
+      if not row.deleted:
+        change['question'] = {
+          'id': row.id,
+          'question': row.question,
+          'answer': row.answer,
+          'category': row.category,
+          'difficulty': row.difficulty
+        }
+      changes.append(change)
+    has_more = len(rows) > limit
+
+    return jsonify({
+      'success': True,
+      'changes': changes,
+      'next': str(changes[-1]['version']) if changes else str(since),
+      'has_more': has_more
+    })
+
+
+
   '''
   Endpoint to DELETE question using a question ID. 
   '''
@@ -170,30 +329,33 @@ def create_app(test_config=None):
     404 error if the question not found
     422 error if there is a problem in deleting the question
     """
+    # Get the question with id = question_id
+    question = Question.query.filter(Question.id == question_id).one_or_none()
+    # Error 404 (not found) if there is no question with id = question_id
+    if question is None:
+      abort(404)
+
     try:
-      # Get the question with id = question_id
-      question = Question.query.filter(Question.id == question_id).one_or_none()
-      # Error 404 (not found) if there is no question with id = question_id
-      if question is None:
-        abort(404)
       # Delete the question
       question.delete()
-
-      return jsonify({
-        'success': True,
-        'deleted': question_id,
-        'total_questions': len(Question.query.all())
-      })
-    except:
+    except SQLAlchemyError:
       # Error 422 if there is a problem in deleting the question
+      db.session.rollback()
       abort(422)
 
+    return jsonify({
+      'success': True,
+      'deleted': question_id,
+      'total_questions': get_cache().get_total_questions()
+    })
+
 
 
   '''
   Endpoint to POST a new question 
   '''
   @app.route('/questions', methods=['POST'])
+  @validate_json(QUESTION_SCHEMA)
   def create_question():
     """ 
     Create a new question
@@ -204,41 +366,32 @@ def create_app(test_config=None):
 
     Raises:
     ------
+    400 error if the body is not valid (question and answer not empty, category and difficulty integers)
     422 error if there is a problem in creating the question
     """
-    # create the body for the POST request for creating the new question
-    body = request.get_json()
-    new_question = body.get('question', None).strip()
-    new_answer = body.get('answer', None).strip()
-    new_category = body.get('category', None)
-    new_difficulty = body.get('difficulty', None)
-
-    # Get all categories
-    categories = Category.query.order_by(Category.id).all()
-    # Format categories dict
-    formatted_categories = {category.id: category.type for category in categories}
+    # Validated body of the POST request for creating the new question
+    body = g.body
 
     try:
-      # Make sure that answer and question not empty 
-      if ((new_question is None) or (new_answer is None) or (new_question == '') or (new_answer == '')):
-        abort(422)
-        
-      question = Question(question=new_question, answer=new_answer, category=new_category, difficulty=new_difficulty)
+      question = Question(question=body['question'], answer=body['answer'], category=body['category'], difficulty=body['difficulty'])
       question.insert()
+    except SQLAlchemyError:
+      db.session.rollback()
+      abort(422)
 
-      selection = Question.query.all()
-      current_questions = paginate_questions(request, selection)
+    selection = Question.query.all()
+    current_questions = paginate_questions(request, selection)
 
-      return jsonify({
-        'success': True,
-        'created': question.id,
-        'questions': current_questions,
-        'categories': formatted_categories,
-        'total_questions': len(Question.query.all())
-      })
-    
-    except:
-      abort(422)
+    # Categories dict (cached)
+    formatted_categories = get_cache().get_categories()
+
+    return jsonify({
+      'success': True,
+      'created': question.id,
+      'questions': current_questions,
+      'categories': formatted_categories,
+      'total_questions': len(selection)
+    })
 
 
 
@@ -248,6 +401,7 @@ def create_app(test_config=None):
   is a substring of the question. 
   '''
   @app.route('/questions/search', methods=['POST'])
+  @validate_json(SEARCH_SCHEMA)
   def search_questions():
     """ 
     Search the questions based on a search term
@@ -258,25 +412,72 @@ def create_app(test_config=None):
 
     Raises:
     ------
-    404 error if there is no question found
-    422 error if there is a problem in searching for the question
+    400 error if searchTerm is missing or not a string
     """
-    body = request.get_json()
-    search_term = body.get('searchTerm', None).strip()
-
-    try: 
-      # list of questions that matches ther searchTerm
-      selection = Question.query.filter(Question.question.ilike('%{}%'.format(search_term)))
-      current_questions = paginate_questions(request, selection)
-
-      return jsonify({
-        'success': True,
-        'questions': current_questions,
-        'total_questions': len(selection.all())
-      })
-    
-    except:
-      abort(422)
+    search_term = g.body['searchTerm']
+
+    # list of questions that matches ther searchTerm
+    selection = Question.query.filter(Question.question.ilike('%{}%'.format(search_term))).all()
+    current_questions = paginate_questions(request, selection)
+
+    return jsonify({
+      'success': True,
+      'questions': current_questions,
+      'total_questions': len(selection)
+    })
+
+
+
+  '''
+  Endpoint to suggest questions and answers while typing.
+  It returns the questions and answers that have a word
+  starting with the query, from the in-memory prefix index.
+  '''
+  @app.route('/questions/suggest')
+  @validate_args(SUGGEST_SCHEMA)
+  def suggest_questions():
+    """
+    Suggest questions and answers based on a prefix
+
+    Returns:
+    -------
+    JSON object includes a list of suggestions (question id, matched field and text)
+
+    Raises:
+    ------
+    400 error if limit is not an integer between 1 and MAX_SUGGESTIONS_LIMIT
+    or q is longer than 200 characters
+    """
+    prefix = g.args['q']
+    limit = g.args['limit']
+
+    # False when the index is full and the suggestions come from the database
+    indexed = True
+    if prefix == '':
+      suggestions = []
+    else:
+      index = get_index()
+      indexed = index.complete
+      if indexed:
+        suggestions = index.search(prefix, limit)
+      else:
+        # The index is full, fall back to the database
+        # (% and _ in the prefix are matched literally, like the index does)
+        pattern = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        suggestions = []
+        for field in ('question', 'answer'):
+          column = getattr(Question, field)
+          rows = Question.query.filter(column.ilike(pattern + '%', escape='\\') | column.ilike('% ' + pattern + '%', escape='\\')) \
+            .order_by(Question.id).limit(limit - len(suggestions)).all()
+          suggestions.extend({'id': row.id, 'field': field, 'text': getattr(row, field)} for row in rows)
+          if len(suggestions) >= limit:
+            break
+
+    return jsonify({
+      'success': True,
+      'suggestions': suggestions,
+      'indexed': indexed
+    })
 
 
 
@@ -284,9 +485,18 @@ def create_app(test_config=None):
   Endpoint to get questions based on category.   
   '''
   @app.route('/categories/<int:category_id>/questions')
+  @validate_args(CATEGORY_QUESTIONS_SCHEMA)
   def retrieve_questions_by_category(category_id):
     """ 
     Retrieve paginated questions based on categotry
+    ordered by id or difficulty (sort, order=asc|desc)
+    or in a random order repeatable with the same seed (order=random&seed=)
+
+    Sorted by id or difficulty, the next page starts after the cursor
+    of the previous one (after=next), an index range scan whatever the
+    depth. page uses OFFSET, which costs the skipped rows. The random
+    order cannot use an index: every page hashes and sorts the whole
+    category (O(questions in the category)).
 
     Parameters:
     ----------
@@ -295,12 +505,15 @@ def create_app(test_config=None):
     
     Returns:
     -------
-    JSON object includes a list of questions per category_id, number of total questions per category_id, current category dict
+    JSON object includes a list of questions per category_id, number of total questions per category_id, current category dict,
+    the seed of the random order and the cursor of the next page
 
     Raises:
     ------
+    400 error if page, sort, order, seed or after are not valid
     404 error if there is no category or no questions
     """
+    args = g.args
 
     # Get the category that has id = category_id
     current_category = Category.query.filter_by(id=category_id).one_or_none()
@@ -308,19 +521,61 @@ def create_app(test_config=None):
     if not current_category:
       abort(404)
     
-    # Select all questions in the (current_category) 
-    selection = Question.query.filter_by(category=category_id).all()
-    # paginate questions
-    current_questions = paginate_questions(request, selection)
+    # Questions in the (current_category) 
+    selection = Question.query.filter_by(category=category_id)
+    seed = None
+    if args['order'] == 'random':
+      if args['after'] is not None:
+        abort(400, description={'after': 'is not supported with order=random'})
+      # Same seed, same order (a new seed is returned if not given)
+      seed = args['seed'] or str(random.getrandbits(32))
+      ordering = (func.md5(func.concat(seed, ':', Question.id)), Question.id)
+    else:
+      # id breaks the ties of difficulty so pages do not shift,
+      # NULL difficulties are sorted (and compared) as UNRATED_DIFFICULTY
+      if args['sort'] == 'id':
+        columns = (Question.id,)
+      else:
+        columns = (func.coalesce(Question.difficulty, UNRATED_DIFFICULTY), Question.id)
+      if args['order'] == 'asc':
+        ordering = columns
+      else:
+        ordering = tuple(column.desc() for column in columns)
+      if args['after'] is not None:
+        if args['page'] != 1:
+          abort(400, description={'after': 'cannot be used with page'})
+        values = parse_cursor(args['after'], args['sort'])
+        if values is None:
+          abort(400, description={'after': 'is not a valid cursor'})
+        # Row comparison on the (category, [coalesce(difficulty),] id) index
+        key = tuple_(*columns)
+        selection = selection.filter(key > tuple_(*values) if args['order'] == 'asc' else key < tuple_(*values))
+
+    # Only the current page (and one more row to know if there is a next page) is loaded
+    start = (args['page'] - 1) * QUESTIONS_PER_PAGE
+    questions = selection.order_by(*ordering).offset(start).limit(QUESTIONS_PER_PAGE + 1).all()
+    current_questions = [question.format() for question in questions[:QUESTIONS_PER_PAGE]]
     # Error 404 if there is no questions
     if len(current_questions) == 0:
       abort(404)
 
+    next_cursor = None
+    if args['order'] != 'random' and len(questions) > QUESTIONS_PER_PAGE:
+      last = questions[QUESTIONS_PER_PAGE - 1]
+      if args['sort'] == 'id':
+        next_cursor = str(last.id)
+      else:
+        difficulty = UNRATED_DIFFICULTY if last.difficulty is None else last.difficulty
+        next_cursor = '{}:{}'.format(difficulty, last.id)
+
     return jsonify({
       'success': True,
       'questions': current_questions,
-      'total_questions': len(selection),
-      'current_category': current_category.format()
+      # Cached count (no scan of the category per page)
+      'total_questions': len(get_cache().get_quiz_ids(category_id)),
+      'current_category': current_category.format(),
+      'seed': seed,
+      'next': next_cursor
     })
 
   
@@ -332,6 +587,7 @@ def create_app(test_config=None):
   if provided, and that is not one of the previous questions. 
   '''
   @app.route('/quizzes', methods=['POST'])
+  @validate_json(QUIZ_SCHEMA)
   def play_get_random_quiz():
     """
     Get random question to play the quiz
@@ -342,49 +598,107 @@ def create_app(test_config=None):
 
     Raises:
     ------
-    422 error if there is a problem 
+    400 error if previous_questions or quiz_category are not valid
+    422 error if there is no questions to play in the category
     """
 
-    body = request.get_json()
+    body = g.body
     # get previous questions
-    previous_questions = body.get('previous_questions')
+    previous_questions = body['previous_questions']
     # get question's category
-    quiz_category = body.get('quiz_category')
-    try:
-      # category id = 0 for selection (All)
-      if quiz_category['id'] == 0:
-        # Get questions without spcify category
-        quizzes = Question.query.all()
-
-      else: 
-        # Get questions filteres by category
-        quizzes = Question.query.filter_by(category=quiz_category['id']).all()
-    
-      # Total quizzes 
-      total_quizzes = len(quizzes)
-      # # Get random quiz
-      random_quiz = random.choice(quizzes).format()
-      
-      # Make sure that the quiz not in the previous questions list
-      while random_quiz['id'] in previous_questions:
-        random_quiz = random.choice(quizzes).format()
-
-        # To check if all question played return no question because may be total question per category is less than 5 
-        # and questionsPerPlay is set to be 5 (QuizView.js file)
-        if total_quizzes == len(previous_questions):
-          return jsonify({
-            'success': True,
-            'total_quizzes': total_quizzes
-          })
-
-      return jsonify({
-        'success': True,
-        'question': random_quiz,
-        'total_quizzes': total_quizzes
-      })
-    except: 
+    quiz_category = body['quiz_category']
+    # Ids of the questions of the category (cached), category id = 0 for selection (All)
+    quiz_ids = get_cache().get_quiz_ids(quiz_category['id'])
+    # Total quizzes 
+    total_quizzes = len(quiz_ids)
+    # Error 422 if there is no questions in the category
+    if total_quizzes == 0:
       abort(422)
 
+    # Make sure that the quiz not in the previous questions list
+    played = set(previous_questions)
+    remaining = [quiz_id for quiz_id in quiz_ids if quiz_id not in played]
+    while remaining:
+      # Get random quiz
+      quiz = Question.query.get(remaining.pop(random.randrange(len(remaining))))
+      # None if the question was deleted by another worker (the cache is not expired yet)
+      if quiz is not None:
+        return jsonify({
+          'success': True,
+          'question': quiz.format(),
+          'total_quizzes': total_quizzes
+        })
+
+    # All question played return no question because may be total question per category is less than 5 
+    # and questionsPerPlay is set to be 5 (QuizView.js file)
+    return jsonify({
+      'success': True,
+      'total_quizzes': total_quizzes
+    })
+
+
+
+  '''
+  Endpoint to get the analytics report of the question bank:
+  questions per category and difficulty, length stats
+  and near-duplicate questions (see analytics.py).
+  '''
+  @app.route('/analytics')
+  def retrieve_analytics():
+    """
+    Retrieve the analytics report of the questions (admin token required)
+
+    The report is computed at most every ANALYTICS_CACHE_SECONDS
+    (per tenant) by one request at a time, the others get the
+    previous report meanwhile. `flask analytics` computes it from
+    the command line.
+
+    Returns:
+    -------
+    JSON object includes the report
+
+    Raises:
+    ------
+    404 error if ANALYTICS_TOKEN is not configured
+    401 error if the X-Analytics-Token header does not match it
+    """
+    token = app.config['ANALYTICS_TOKEN']
+    if not token:
+      abort(404)
+    if not token_matches(request.headers.get(ANALYTICS_TOKEN_HEADER), token):
+      abort(401)
+
+    extensions = namespace()
+    lock = extensions.setdefault('analytics_lock', threading.Lock())
+    max_age = app.config.get('ANALYTICS_CACHE_SECONDS', ANALYTICS_CACHE_SECONDS)
+
+    def expired(cached):
+      return cached is None or time.monotonic() - cached[0] > max_age
+
+    cached = extensions.get('analytics_report')
+    # Only the first report is waited for, a stale one is served while it is recomputed
+    if expired(cached) and lock.acquire(blocking=cached is None):
+      try:
+        cached = extensions.get('analytics_report')
+        if expired(cached):
+          cached = (time.monotonic(), question_bank_report())
+          extensions['analytics_report'] = cached
+      finally:
+        lock.release()
+
+    return jsonify({
+      'success': True,
+      'report': cached[1]
+    })
+
+
+  @app.cli.command('analytics')
+  @click.option('--chunk-size', default=CHUNK_SIZE, help='Rows loaded per chunk.')
+  @click.option('--threshold', default=DUPLICATE_THRESHOLD, help='Minimum similarity of near-duplicates.')
+  def analytics_command(chunk_size, threshold):
+    """ Print the analytics report of the question bank as JSON """
+    click.echo(json.dumps(question_bank_report(chunk_size, threshold), indent=2))
+
 
 
   '''
@@ -441,14 +755,39 @@ def create_app(test_config=None):
 
     Returns:
     -------
-    JSON objects includes error's status code 400 (int)
-    and a message to the user (string)
+    JSON objects includes error's status code 400 (int),
+    a message to the user (string)
+    and field-level errors (dict) if the request body is not valid
     """
-    return jsonify({
+    response = {
       "success": False, 
       "error": 400,
       "message": "Bad Request"
-      }), 400
+      }
+    # Field-level messages from validate_json
+    if isinstance(error.description, dict):
+      response["errors"] = error.description
+    return jsonify(response), 400
+
+
+  '''
+  Error 401 (Unauthorized)
+  '''
+  @app.errorhandler(401)
+  def unauthorized(error):
+    """
+    Function unauthorized handle error 401 
+
+    Returns:
+    -------
+    JSON objects includes error's status code 401 (int)
+    and a message to the user (string)
+    """
+    return jsonify({
+      "success": False, 
+      "error": 401,
+      "message": "Unauthorized"
+      }), 401
 
 
   '''
@@ -0,0 +1,412 @@
+import itertools
+import re
+import time
+import numpy as np
+
+from models import db, Question
+
+
+'''
+Analytics report over the question bank
+  The questions table is read in chunks of CHUNK_SIZE rows (keyset
+  pagination on id), each chunk is turned into NumPy arrays and the
+  aggregates are computed vectorized and merged, so their memory
+  depends on the chunk size, not on the number of rows:
+    - questions per category, per difficulty and per (category, difficulty)
+    - length stats of the questions and answers (mean, std, percentiles)
+  Near-duplicate questions: MinHash signatures of hashed word shingles
+  with LSH banding give candidate pairs, which are then checked with the
+  exact Jaccard similarity of their shingles. Finding the pairs needs
+  the band keys of all the rows: BANDS keys and the id of every
+  question, 8 * (BANDS + 1) = 72 bytes per row (about 70 MB per
+  million questions) plus 24 bytes per row for the band being sorted.
+'''
+
+CHUNK_SIZE = 10000
+# Words per shingle
+SHINGLE_SIZE = 3
+# MinHash signature = BANDS * ROWS_PER_BAND values
+BANDS = 8
+ROWS_PER_BAND = 4
+# Minimum Jaccard similarity of near-duplicates
+DUPLICATE_THRESHOLD = 0.8
+# Upper bound of the candidate pairs checked
+MAX_CANDIDATE_PAIRS = 100000
+# Lengths above are counted in the last bin of the histograms (percentiles)
+MAX_LENGTH = 1000
+
+WORD_PATTERN = re.compile(r'\w+')
+# Texts of a chunk are joined with SEPARATOR, matched as a token of its own
+# (PostgreSQL text cannot contain it)
+SEPARATOR = '\x00'
+TOKEN_PATTERN = re.compile(r'\w+|\x00')
+_SEPARATOR_HASH = hash(SEPARATOR)
+# (category, difficulty) pairs are counted as category code * _PAIR_BASE + difficulty + 1
+_PAIR_BASE = 1 << 20
+# Random odd multipliers and offsets of the MinHash permutations (fixed seed: stable signatures)
+_rng = np.random.RandomState(2020)
+_PERMUTATION_A = _rng.randint(1, 2 ** 62, size=BANDS * ROWS_PER_BAND, dtype=np.int64).astype(np.uint64) | np.uint64(1)
+_PERMUTATION_B = _rng.randint(0, 2 ** 62, size=BANDS * ROWS_PER_BAND, dtype=np.int64).astype(np.uint64)
+_SHINGLE_MULTIPLIERS = [np.uint64(0x9E3779B97F4A7C15), np.uint64(0xC2B2AE3D27D4EB4F), np.uint64(1)]
+
+
+def _words(text):
+  return WORD_PATTERN.findall((text or '').lower())
+
+
+
+def shingles(text):
+  """
+  Word shingles of a text (SHINGLE_SIZE consecutive words)
+
+  Returns:
+  -------
+  shingles: set
+    tuples of words, one tuple of all the words for short texts
+  """
+  words = _words(text)
+  if len(words) <= SHINGLE_SIZE:
+    return {tuple(words)} if words else set()
+  return {tuple(words[position:position + SHINGLE_SIZE]) for position in range(len(words) - SHINGLE_SIZE + 1)}
+
+
+
+def minhash_signatures(texts):
+  """
+  MinHash signatures of texts, vectorized over all the shingles of the texts
+
+  Parameters:
+  ----------
+  texts: list
+    list of str
+
+  Returns:
+  -------
+  signatures: numpy array (len(texts), BANDS * ROWS_PER_BAND) of uint64
+  has_words: numpy array (len(texts),) of bool, texts without words have no signature
+  """
+  # Tokenize and hash the whole chunk at once, SEPARATOR tokens end the texts
+  tokens = TOKEN_PATTERN.findall(SEPARATOR.join(texts).lower() + SEPARATOR)
+  hashes = np.fromiter(map(hash, tokens), dtype=np.int64, count=len(tokens))
+  ends = np.nonzero(hashes == _SEPARATOR_HASH)[0]
+  # Words of each text, and the position of its first word
+  counts = np.diff(np.concatenate(([-1], ends))) - 1
+  starts = ends - counts
+  has_words = counts > 0
+  signatures = np.full((len(texts), BANDS * ROWS_PER_BAND), np.iinfo(np.uint64).max, dtype=np.uint64)
+  if not has_words.any():
+    return signatures, has_words
+
+  hashes = hashes.astype(np.uint64)
+  # Short texts have one shingle of all their words
+  shingle_counts = np.where(has_words, np.maximum(counts - SHINGLE_SIZE + 1, 1), 0)
+  first_shingle = np.concatenate(([0], np.cumsum(shingle_counts)[:-1]))
+  positions = np.repeat(starts - first_shingle, shingle_counts) + np.arange(shingle_counts.sum())
+  words_left = np.repeat(counts, shingle_counts) - (positions - np.repeat(starts, shingle_counts))
+  shingle_hashes = np.zeros(len(positions), dtype=np.uint64)
+  for offset, multiplier in enumerate(_SHINGLE_MULTIPLIERS):
+    word = hashes[np.minimum(positions + offset, len(hashes) - 1)] * multiplier
+    shingle_hashes ^= np.where(offset < words_left, word, np.uint64(0))
+
+  # Minimum of each permutation over the shingles of each text
+  reduce_at = first_shingle[has_words]
+  for number in range(BANDS * ROWS_PER_BAND):
+    values = (shingle_hashes * _PERMUTATION_A[number] + _PERMUTATION_B[number]) >> np.uint64(32)
+    signatures[has_words, number] = np.minimum.reduceat(values, reduce_at)
+  return signatures, has_words
+
+
+
+def band_keys(signatures):
+  """
+  LSH band keys of MinHash signatures
+
+  Returns:
+  -------
+  keys: numpy array (BANDS, len(signatures)) of uint64
+    texts with the same key in any band are candidate duplicates
+  """
+  keys = np.zeros((BANDS, len(signatures)), dtype=np.uint64)
+  for band in range(BANDS):
+    for row in range(ROWS_PER_BAND):
+      keys[band] = keys[band] * np.uint64(0x100000001B3) ^ signatures[:, band * ROWS_PER_BAND + row]
+  return keys
+
+
+
+class _LengthStats(object):
+  """ Streaming count, sum, min, max and histogram of lengths """
+  def __init__(self):
+    self.count = 0
+    self.total = 0.0
+    self.total_squares = 0.0
+    self.minimum = None
+    self.maximum = None
+    self.histogram = np.zeros(MAX_LENGTH + 1, dtype=np.int64)
+
+  def add(self, lengths):
+    if len(lengths) == 0:
+      return
+    self.count += len(lengths)
+    self.total += float(lengths.sum())
+    self.total_squares += float((lengths.astype(np.float64) ** 2).sum())
+    minimum, maximum = int(lengths.min()), int(lengths.max())
+    self.minimum = minimum if self.minimum is None else min(self.minimum, minimum)
+    self.maximum = maximum if self.maximum is None else max(self.maximum, maximum)
+    self.histogram += np.bincount(np.minimum(lengths, MAX_LENGTH), minlength=MAX_LENGTH + 1)
+
+  def percentile(self, fraction):
+    position = np.searchsorted(np.cumsum(self.histogram), fraction * self.count)
+    return int(min(position, self.maximum))
+
+  def format(self):
+    if self.count == 0:
+      return {'count': 0}
+    mean = self.total / self.count
+    return {
+      'count': self.count,
+      'mean': round(mean, 2),
+      'std': round(max(self.total_squares / self.count - mean ** 2, 0) ** 0.5, 2),
+      'min': self.minimum,
+      'median': self.percentile(0.5),
+      'p90': self.percentile(0.9),
+      'max': self.maximum
+    }
+
+
+
+def _merge_counts(counts, keys):
+  values, value_counts = np.unique(keys, return_counts=True)
+  for value, count in zip(values.tolist(), value_counts.tolist()):
+    counts[value] = counts.get(value, 0) + count
+
+
+
+def _category_labels():
+  """
+  Integer codes of the category values (questions.category is a string column)
+
+  Returns:
+  -------
+  code: function
+    code(value) returns the code of a category value
+  labels: list
+    code -> label: int for numeric categories, -1 if missing, the string otherwise
+  """
+  codes = {}
+  labels = []
+
+  def code(value):
+    number = codes.get(value)
+    if number is None:
+      if value is None:
+        label = -1
+      else:
+        try:
+          label = int(value)
+        except ValueError:
+          label = str(value)
+      number = codes[value] = len(labels)
+      labels.append(label)
+    return number
+
+  return code, labels
+
+
+
+def _label_order(label):
+  # Numeric categories first, then the others by name
+  return (isinstance(label, str), label)
+
+
+
+def _candidate_pairs(band_chunks, ids, max_pairs):
+  """
+  Pairs of ids with the same key in a band (all the pairs of each bucket)
+
+  Parameters:
+  ----------
+  band_chunks: list
+    for each band, the list of the band keys of each chunk,
+    emptied band by band to free their memory
+  ids: numpy array
+    ids of the rows of the concatenated chunks
+  """
+  pairs = set()
+  for band in range(len(band_chunks)):
+    keys = np.concatenate(band_chunks[band])
+    band_chunks[band] = None
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    sorted_ids = ids[order]
+    del keys, order
+    # Buckets are runs of the same key, only the ones of 2 ids or more have pairs
+    starts = np.flatnonzero(np.concatenate(([True], sorted_keys[1:] != sorted_keys[:-1])))
+    ends = np.append(starts[1:], len(sorted_keys))
+    shared = ends - starts > 1
+    for start, end in zip(starts[shared].tolist(), ends[shared].tolist()):
+      for first, second in itertools.combinations(sorted_ids[start:end].tolist(), 2):
+        pairs.add((min(first, second), max(first, second)))
+        if len(pairs) >= max_pairs:
+          return pairs
+  return pairs
+
+
+
+def _clusters(pairs):
+  """ Groups of ids connected by pairs (union-find) """
+  parents = {}
+
+  def find(node):
+    parents.setdefault(node, node)
+    while parents[node] != node:
+      parents[node] = parents[parents[node]]
+      node = parents[node]
+    return node
+
+  for first, second in pairs:
+    parents[find(first)] = find(second)
+  groups = {}
+  for node in list(parents):
+    groups.setdefault(find(node), []).append(node)
+  return sorted(sorted(group) for group in groups.values())
+
+
+
+def analyze(chunks, load_texts, threshold=DUPLICATE_THRESHOLD, max_pairs=MAX_CANDIDATE_PAIRS):
+  """
+  Compute the report from chunks of rows
+
+  Parameters:
+  ----------
+  chunks: iterable
+    lists of (id, category, difficulty, question, answer) rows
+  load_texts: function
+    load_texts(ids) returns a dict id -> question text (to check the candidate duplicates)
+  threshold: float
+    minimum Jaccard similarity of near-duplicates
+  max_pairs: int
+    maximum number of candidate pairs checked
+
+  Returns:
+  -------
+  report: dict
+  """
+  started = time.perf_counter()
+  categories = {}
+  difficulties = {}
+  category_difficulties = {}
+  category_code, category_labels = _category_labels()
+  question_lengths = _LengthStats()
+  answer_lengths = _LengthStats()
+  # Band keys per band then per chunk (the bands are sorted one by one)
+  band_chunks = [[] for _ in range(BANDS)]
+  all_ids = []
+  total = 0
+
+  for rows in chunks:
+    if not rows:
+      continue
+    total += len(rows)
+    ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+    # Codes of the categories, -1 for missing difficulty
+    category = np.fromiter((category_code(row[1]) for row in rows), dtype=np.int64, count=len(rows))
+    difficulty = np.fromiter((-1 if row[2] is None else int(row[2]) for row in rows), dtype=np.int64, count=len(rows))
+    texts = [row[3] or '' for row in rows]
+
+    _merge_counts(categories, category)
+    _merge_counts(difficulties, difficulty)
+    # Pair of (category, difficulty) as one int64 key
+    _merge_counts(category_difficulties, category * _PAIR_BASE + difficulty + 1)
+    question_lengths.add(np.fromiter(map(len, texts), dtype=np.int64, count=len(rows)))
+    answer_lengths.add(np.fromiter((len(row[4] or '') for row in rows), dtype=np.int64, count=len(rows)))
+
+    signatures, has_words = minhash_signatures(texts)
+    keys = band_keys(signatures[has_words])
+    for band in range(BANDS):
+      band_chunks[band].append(keys[band].copy())
+    all_ids.append(ids[has_words])
+
+  duplicates = []
+  candidates = 0
+  if all_ids:
+    ids = np.concatenate(all_ids)
+    del all_ids
+    pairs = _candidate_pairs(band_chunks, ids, max_pairs)
+    candidates = len(pairs)
+    texts = load_texts(sorted({question_id for pair in pairs for question_id in pair}))
+    text_shingles = {question_id: shingles(text) for question_id, text in texts.items()}
+    similar = []
+    for first, second in pairs:
+      first_shingles, second_shingles = text_shingles.get(first), text_shingles.get(second)
+      if not first_shingles or not second_shingles:
+        continue
+      similarity = len(first_shingles & second_shingles) / len(first_shingles | second_shingles)
+      if similarity >= threshold:
+        similar.append((first, second))
+    for group in _clusters(similar):
+      duplicates.append({'ids': group, 'question': texts[group[0]]})
+
+  return {
+    'total_questions': total,
+    'categories': {str(category_labels[key]): count
+                   for key, count in sorted(categories.items(), key=lambda item: _label_order(category_labels[item[0]]))},
+    'difficulties': {str(key): count for key, count in sorted(difficulties.items())},
+    'category_difficulties': [
+      {'category': category_labels[key // _PAIR_BASE], 'difficulty': key % _PAIR_BASE - 1, 'count': count}
+      for key, count in sorted(category_difficulties.items(),
+                               key=lambda item: (_label_order(category_labels[item[0] // _PAIR_BASE]), item[0] % _PAIR_BASE))
+    ],
+    'question_length': question_lengths.format(),
+    'answer_length': answer_lengths.format(),
+    'duplicates': duplicates,
+    'duplicate_candidates': candidates,
+    'duration_ms': round((time.perf_counter() - started) * 1000, 1)
+  }
+
+
+
+def question_chunks(chunk_size=CHUNK_SIZE):
+  """
+  Rows of the questions table in chunks (keyset pagination on id)
+
+  Yields:
+  ------
+  rows: list
+    (id, category, difficulty, question, answer) tuples
+  """
+  last_id = 0
+  while True:
+    rows = db.session.query(Question.id, Question.category, Question.difficulty, Question.question, Question.answer) \
+      .filter(Question.id > last_id).order_by(Question.id).limit(chunk_size).all()
+    if not rows:
+      return
+    yield rows
+    last_id = rows[-1][0]
+
+
+
+def load_question_texts(ids):
+  """
+  Returns:
+  -------
+  texts: dict
+    question id -> question text
+  """
+  texts = {}
+  for start in range(0, len(ids), CHUNK_SIZE):
+    rows = db.session.query(Question.id, Question.question).filter(Question.id.in_(ids[start:start + CHUNK_SIZE])).all()
+    texts.update(rows)
+  return texts
+
+
+
+def question_bank_report(chunk_size=CHUNK_SIZE, threshold=DUPLICATE_THRESHOLD):
+  """
+  Compute the report of the questions table
+
+  Returns:
+  -------
+  report: dict
+  """
+  return analyze(question_chunks(chunk_size), load_question_texts, threshold=threshold)
@@ -0,0 +1,120 @@
+import time
+from flask import current_app
+
+from models import db, Question, Category, question_listeners
+from .tenancy import namespace
+
+
+'''
+Per-app caches of the data read on (almost) every request
+  categories, the total number of questions and the question ids
+  of each category (used to pick random quizzes). Categories do not
+  change through the API, counts and quiz ids are reset when a
+  question is inserted or deleted and reloaded on next use.
+  Every worker process has its own cache, so counts and quiz ids
+  also expire after `ttl` seconds to see the changes made by the
+  other workers (the suggest index uses the same TTL).
+  serving.preload() fills them before forking.
+'''
+
+# Seconds before the question caches are reloaded (app.config['QUESTION_CACHE_TTL'])
+QUESTION_CACHE_TTL = 60
+
+
+class TriviaCache(object):
+  """ Cached categories, total questions and quiz ids per category """
+  def __init__(self, ttl=QUESTION_CACHE_TTL):
+    self.ttl = ttl
+    self.categories = None
+    self.total_questions = None
+    # category id (str, as stored in questions.category) -> list of question ids
+    self.quiz_ids = None
+    self.loaded_at = time.monotonic()
+
+  def _expire_questions(self):
+    if time.monotonic() - self.loaded_at > self.ttl:
+      self.reset_questions()
+
+  def get_categories(self):
+    """
+    Returns:
+    -------
+    categories: dict
+      category id -> category type ordered by id
+    """
+    if self.categories is None:
+      categories = Category.query.order_by(Category.id).all()
+      self.categories = {category.id: category.type for category in categories}
+    return self.categories
+
+  def get_total_questions(self):
+    """
+    Returns:
+    -------
+    total_questions: int
+      the number of questions
+    """
+    self._expire_questions()
+    if self.total_questions is None:
+      self.total_questions = Question.query.count()
+    return self.total_questions
+
+  def get_quiz_ids(self, category_id):
+    """
+    Parameters:
+    ----------
+    category_id: int
+      id of the category, 0 for all categories
+
+    Returns:
+    -------
+    ids: list
+      ids of the questions of the category ordered by id
+    """
+    self._expire_questions()
+    quiz_ids = self.quiz_ids
+    if quiz_ids is None:
+      quiz_ids = {'0': []}
+      for question_id, category in db.session.query(Question.id, Question.category).order_by(Question.id):
+        quiz_ids['0'].append(question_id)
+        quiz_ids.setdefault(str(category), []).append(question_id)
+      self.quiz_ids = quiz_ids
+    return quiz_ids.get(str(category_id), [])
+
+  def reset_questions(self):
+    """ Reset the caches that depend on the questions table """
+    self.total_questions = None
+    self.quiz_ids = None
+    self.loaded_at = time.monotonic()
+
+  def warm(self):
+    """ Load all the caches """
+    self.get_categories()
+    self.get_total_questions()
+    self.get_quiz_ids(0)
+
+
+
+def get_cache():
+  """
+  Get the cache of the app (or of the request's tenant)
+
+  Returns:
+  -------
+  cache: TriviaCache
+  """
+  extensions = namespace()
+  if 'trivia_cache' not in extensions:
+    extensions['trivia_cache'] = TriviaCache(current_app.config.get('QUESTION_CACHE_TTL', QUESTION_CACHE_TTL))
+  return extensions['trivia_cache']
+
+
+
+def _on_question_change(action, question):
+  """ Reset the question caches of the current app (or tenant) on Question.insert()/delete() """
+  cache = namespace().get('trivia_cache')
+  if cache is not None:
+    cache.reset_questions()
+
+
+question_listeners.append(_on_question_change)
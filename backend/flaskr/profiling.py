@@ -0,0 +1,278 @@
+import cProfile
+import hmac
+import io
+import json
+import os
+import pstats
+import random
+import tempfile
+import time
+from flask import request, g, abort, jsonify, send_file, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+'''
+On-demand request profiling
+  Off by default: nothing is registered unless a token or a
+  sampling rate is configured (app.config or environment):
+    PROFILE_TOKEN: requests with the header `X-Profile: <token>` are
+      profiled, the same token (header `X-Profile-Token`) is needed
+      by the /admin/profiles endpoints
+    PROFILE_SAMPLE_RATE: fraction of the requests profiled (0 to 1)
+    PROFILE_DIR: directory of the profiles (ring buffer)
+    PROFILE_KEEP: number of profiles kept, the oldest are removed
+  Each profile is a cProfile dump (<name>.prof) and a summary with the
+  SQL statements and their timings (<name>.json).
+'''
+
+PROFILE_HEADER = 'X-Profile'
+PROFILE_TOKEN_HEADER = 'X-Profile-Token'
+PROFILE_KEEP = 50
+# Functions listed in a profile's summary
+TOP_FUNCTIONS = 30
+
+_sql_listeners_registered = False
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+  profile = g.get('profile') if has_request_context() else None
+  if profile is not None:
+    conn.info.setdefault('profile_query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+  profile = g.get('profile') if has_request_context() else None
+  starts = conn.info.get('profile_query_start')
+  if profile is not None and starts:
+    started = starts.pop()
+    profile['sql'].append({
+      'statement': statement,
+      'duration_ms': round((time.perf_counter() - started) * 1000, 3)
+    })
+
+
+def _register_sql_listeners():
+  """ Time the SQL statements of profiled requests (all engines, once) """
+  global _sql_listeners_registered
+  if not _sql_listeners_registered:
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    _sql_listeners_registered = True
+
+
+
+def token_matches(value, token):
+  """ Constant-time comparison of a header value with the token """
+  return value is not None and hmac.compare_digest(value.encode('utf-8'), token.encode('utf-8'))
+
+
+
+def _profile_paths(directory):
+  """
+  Returns:
+  -------
+  names: list
+    names of the stored profiles, oldest first
+  """
+  if not os.path.isdir(directory):
+    return []
+  return sorted(name[:-len('.json')] for name in os.listdir(directory) if name.endswith('.json'))
+
+
+
+def _save_profile(app, profile, response):
+  """
+  Store the profile and remove the oldest beyond PROFILE_KEEP
+
+  Returns:
+  -------
+  name: str
+    name of the stored profile
+  """
+  directory = app.config['PROFILE_DIR']
+  os.makedirs(directory, exist_ok=True)
+  # Sortable by time, unique across worker processes
+  name = '{:020d}-{}'.format(time.time_ns(), os.getpid())
+
+  stats = pstats.Stats(profile['profiler'])
+  stats.dump_stats(os.path.join(directory, name + '.prof'))
+  summary = {
+    'name': name,
+    'method': request.method,
+    'path': request.full_path.rstrip('?'),
+    'endpoint': request.endpoint,
+    'status': response.status_code,
+    'started_at': profile['started_at'],
+    'duration_ms': round((time.perf_counter() - profile['start']) * 1000, 3),
+    'sql_count': len(profile['sql']),
+    'sql_duration_ms': round(sum(query['duration_ms'] for query in profile['sql']), 3),
+    'sql': profile['sql']
+  }
+  with open(os.path.join(directory, name + '.json'), 'w') as summary_file:
+    json.dump(summary, summary_file)
+
+  for old in _profile_paths(directory)[:-app.config['PROFILE_KEEP']]:
+    for extension in ('.json', '.prof'):
+      try:
+        os.remove(os.path.join(directory, old + extension))
+      except FileNotFoundError:
+        pass
+  return name
+
+
+
+def _top_functions(directory, name):
+  """
+  Returns:
+  -------
+  functions: list
+    the TOP_FUNCTIONS functions of a profile by cumulative time
+  """
+  output = io.StringIO()
+  stats = pstats.Stats(os.path.join(directory, name + '.prof'), stream=output)
+  stats.sort_stats('cumulative')
+  functions = []
+  for function in stats.fcn_list[:TOP_FUNCTIONS]:
+    calls, primitive_calls, total_time, cumulative_time, callers = stats.stats[function]
+    functions.append({
+      'function': '{}:{}({})'.format(*function),
+      'calls': calls,
+      'total_time_ms': round(total_time * 1000, 3),
+      'cumulative_time_ms': round(cumulative_time * 1000, 3)
+    })
+  return functions
+
+
+
+def init_profiling(app):
+  """
+  Set up on-demand profiling if PROFILE_TOKEN or PROFILE_SAMPLE_RATE is configured
+
+  When profiling is off no hook is registered (no overhead).
+
+  Raises:
+  ------
+  ValueError if PROFILE_KEEP is less than 1 or PROFILE_SAMPLE_RATE is not between 0 and 1
+  """
+  app.config.setdefault('PROFILE_TOKEN', os.environ.get('PROFILE_TOKEN'))
+  app.config.setdefault('PROFILE_SAMPLE_RATE', float(os.environ.get('PROFILE_SAMPLE_RATE', 0)))
+  app.config.setdefault('PROFILE_DIR', os.environ.get('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'trivia-profiles')))
+  app.config.setdefault('PROFILE_KEEP', int(os.environ.get('PROFILE_KEEP', PROFILE_KEEP)))
+
+  token = app.config['PROFILE_TOKEN']
+  sample_rate = app.config['PROFILE_SAMPLE_RATE']
+  # PROFILE_KEEP = 0 would trim nothing ([:-0] is empty) and keep every profile
+  if app.config['PROFILE_KEEP'] < 1:
+    raise ValueError('PROFILE_KEEP must be at least 1, got {}'.format(app.config['PROFILE_KEEP']))
+  if not 0 <= sample_rate <= 1:
+    raise ValueError('PROFILE_SAMPLE_RATE must be between 0 and 1, got {}'.format(sample_rate))
+  if not token and not sample_rate:
+    return
+
+  _register_sql_listeners()
+
+  def check_token():
+    if not token:
+      abort(404)
+    if not token_matches(request.headers.get(PROFILE_TOKEN_HEADER), token):
+      abort(401)
+
+  @app.before_request
+  def start_profile():
+    requested = token and token_matches(request.headers.get(PROFILE_HEADER), token)
+    if not requested and not (sample_rate and random.random() < sample_rate):
+      return
+    # Do not profile the admin endpoints
+    if request.path.startswith('/admin/profiles'):
+      return
+    profiler = cProfile.Profile()
+    g.profile = {'profiler': profiler, 'sql': [], 'started_at': time.time(), 'start': time.perf_counter()}
+    profiler.enable()
+
+  @app.after_request
+  def stop_profile(response):
+    profile = g.pop('profile', None)
+    if profile is not None:
+      profile['profiler'].disable()
+      response.headers['X-Profile-Name'] = _save_profile(app, profile, response)
+    return response
+
+  @app.teardown_request
+  def discard_profile(error):
+    # after_request is skipped on unhandled exceptions, stop the profiler anyway
+    profile = g.pop('profile', None)
+    if profile is not None:
+      profile['profiler'].disable()
+
+  '''
+  Admin endpoints to list and read the stored profiles
+  '''
+  @app.route('/admin/profiles')
+  def list_profiles():
+    """
+    List the stored profiles, newest first
+
+    Returns:
+    -------
+    JSON object includes a list of profiles summaries (without the SQL statements)
+
+    Raises:
+    ------
+    401 error if the X-Profile-Token header is not the PROFILE_TOKEN
+    404 error if PROFILE_TOKEN is not configured
+    """
+    check_token()
+    directory = app.config['PROFILE_DIR']
+    profiles = []
+    for name in reversed(_profile_paths(directory)):
+      try:
+        with open(os.path.join(directory, name + '.json')) as summary_file:
+          summary = json.load(summary_file)
+      except (FileNotFoundError, ValueError):
+        # Removed (or being written) by another worker
+        continue
+      summary.pop('sql')
+      profiles.append(summary)
+
+    return jsonify({
+      'success': True,
+      'profiles': profiles
+    })
+
+  @app.route('/admin/profiles/<name>')
+  def retrieve_profile(name):
+    """
+    Retrieve a stored profile
+
+    Parameters:
+    ----------
+    name: str
+      name of the profile
+
+    Returns:
+    -------
+    JSON object includes the profile summary, the SQL statements
+    with timings and the top functions by cumulative time,
+    or the cProfile dump with ?format=prof (for pstats/snakeviz)
+
+    Raises:
+    ------
+    401 error if the X-Profile-Token header is not the PROFILE_TOKEN
+    404 error if PROFILE_TOKEN is not configured or there is no profile
+    """
+    check_token()
+    directory = app.config['PROFILE_DIR']
+    if name not in _profile_paths(directory):
+      abort(404)
+    if request.args.get('format') == 'prof':
+      return send_file(os.path.join(directory, name + '.prof'), mimetype='application/octet-stream',
+                       as_attachment=True, attachment_filename=name + '.prof')
+    with open(os.path.join(directory, name + '.json')) as summary_file:
+      summary = json.load(summary_file)
+    summary['functions'] = _top_functions(directory, name)
+
+    return jsonify({
+      'success': True,
+      'profile': summary
+    })
@@ -0,0 +1,119 @@
+import gc
+import os
+import random
+import time
+import multiprocessing
+
+from models import db
+from .cache import get_cache
+from .suggest import get_index
+
+
+'''
+Production serving (see gunicorn.conf.py and wsgi.py)
+  The app is created and its caches are warmed once in the parent
+  process, then gunicorn forks the workers (preload_app = True), so
+  every worker starts warm and the cached objects are shared
+  copy-on-write between the workers. The forked caches carry the
+  parent's load time, stagger() gives each worker its own expiry.
+'''
+
+# Upper bound of the default number of workers
+MAX_WORKERS = 16
+
+
+def _positive_int(environ, name, default):
+  value = environ.get(name)
+  if value is None or value.strip() == '':
+    return default
+  try:
+    value = int(value)
+  except ValueError:
+    raise ValueError('{} must be an integer, got {!r}'.format(name, environ.get(name)))
+  if value < 1:
+    raise ValueError('{} must be at least 1, got {}'.format(name, value))
+  return value
+
+
+
+def worker_config(environ=None, cpu_count=None):
+  """
+  Number of worker processes and threads per worker
+
+  Parameters:
+  ----------
+  environ: dict
+    environment variables (default os.environ)
+      WEB_CONCURRENCY: number of workers,
+        default is 2 * cpu_count + 1 (at most MAX_WORKERS)
+      THREADS: number of threads per worker, default is 1
+        (more than 1 uses gunicorn's gthread worker)
+  cpu_count: int
+    number of cores (default multiprocessing.cpu_count())
+
+  Returns:
+  -------
+  config: dict
+    `workers`, `threads` and `worker_class` for gunicorn
+
+  Raises:
+  ------
+  ValueError if WEB_CONCURRENCY or THREADS is not a positive integer
+  """
+  environ = os.environ if environ is None else environ
+  cpu_count = cpu_count or multiprocessing.cpu_count()
+  workers = _positive_int(environ, 'WEB_CONCURRENCY', min(2 * cpu_count + 1, MAX_WORKERS))
+  threads = _positive_int(environ, 'THREADS', 1)
+  return {
+    'workers': workers,
+    'threads': threads,
+    'worker_class': 'gthread' if threads > 1 else 'sync'
+  }
+
+
+
+def preload(app):
+  """
+  Prepare the app in the parent process before forking the workers
+
+  Warm the categories, counts, quiz ids and suggest index,
+  close the database connections (they must not be shared by
+  the workers, each worker opens its own pool) and move the
+  warmed objects out of the garbage collector's tracking so
+  collections in the workers do not touch (and copy) their pages.
+  """
+  with app.app_context():
+    get_cache().warm()
+    get_index()
+    db.session.remove()
+    db.get_engine(app).dispose()
+  gc.collect()
+  gc.freeze()
+  return app
+
+
+
+def stagger(app, rng=random):
+  """
+  Spread the reloads of the warmed caches over the workers (gunicorn post_fork)
+
+  The caches warmed by preload() in the parent would expire at the
+  same moment in every worker, so all of them would reload the
+  questions together. Each worker ages its copies by a random part
+  of QUESTION_CACHE_TTL instead.
+
+  Parameters:
+  ----------
+  app: Flask
+    the preloaded app, in the forked worker
+  rng: random.Random
+    source of the random ages (random is reseeded in each forked worker)
+  """
+  now = time.monotonic()
+  cache = app.extensions.get('trivia_cache')
+  if cache is not None:
+    cache.loaded_at = now - rng.uniform(0, cache.ttl)
+  index = app.extensions.get('suggest_index')
+  if index is not None and index.built and index.ttl is not None:
+    index.built_at = now - rng.uniform(0, index.ttl)
+  return app
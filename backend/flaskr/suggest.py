@@ -0,0 +1,293 @@
+import threading
+import time
+from bisect import bisect_left, insort
+from flask import current_app, g
+from sqlalchemy.exc import SQLAlchemyError
+
+from models import db, Question, question_listeners
+from .tenancy import namespace
+from .cache import QUESTION_CACHE_TTL
+
+
+'''
+Prefix index for search-as-you-type
+  A sorted array of (key, question id, field) entries, one for the
+  start of every word of every question and answer. The key is the
+  lowercased text from that word, truncated to KEY_LENGTH characters,
+  so a prefix lookup is a binary search plus a short scan.
+  The index is kept up to date by Question.insert() and delete()
+  of the same process, and rebuilt after QUESTION_CACHE_TTL seconds
+  to see the changes made by the other workers (like TriviaCache).
+  The rebuild runs in a background thread, one at a time, and the
+  expired index answers the lookups until the new one is swapped in.
+  It holds at most SUGGEST_MAX_ENTRIES entries (app.config, about
+  12 per question, 150 bytes each): a larger questions table is
+  not indexed and the suggestions come from the database.
+'''
+
+# Characters of text kept per entry (longer prefixes are checked on the full text)
+KEY_LENGTH = 32
+# Default upper bound of the number of entries (app.config['SUGGEST_MAX_ENTRIES'])
+MAX_ENTRIES = 500000
+
+FIELDS = ('question', 'answer')
+
+
+def _keys(text):
+  """
+  Index keys of a text, one for the start of every word
+
+  Returns:
+  -------
+  keys: set
+    lowercased text from each word start, truncated to KEY_LENGTH
+  """
+  text = (text or '').lower()
+  keys = set()
+  for position, char in enumerate(text):
+    if not char.isspace() and (position == 0 or text[position - 1].isspace()):
+      keys.add(text[position:position + KEY_LENGTH])
+  return keys
+
+
+
+class PrefixIndex(object):
+  """
+  In-memory prefix index of the questions table
+
+  Parameters:
+  ----------
+  max_entries: int
+    when the index would exceed max_entries its entries are dropped
+    and `complete` is False, so callers fall back to the database
+  ttl: int
+    seconds before the index is expired (None: never)
+  """
+  def __init__(self, max_entries=MAX_ENTRIES, ttl=None):
+    self.max_entries = max_entries
+    self.ttl = ttl
+    self.built_at = None
+    self.entries = []
+    # question id -> {'question': text, 'answer': text}
+    self.texts = {}
+    self.complete = True
+    self.built = False
+    self.lock = threading.Lock()
+    # Only one thread builds the index the first time
+    self.build_lock = threading.Lock()
+    # Changes made while a rebuild runs (replayed on the new index), None if no rebuild runs
+    self.pending = None
+    self.rebuild_thread = None
+
+  def _add(self, question_id, question, answer):
+    entries = [(key, question_id, field)
+               for field, text in zip(FIELDS, (question, answer))
+               for key in _keys(text)]
+    if len(self.entries) + len(entries) > self.max_entries:
+      self._drop()
+      return
+    for entry in entries:
+      insort(self.entries, entry)
+    self.texts[question_id] = {'question': question, 'answer': answer}
+
+  def _drop(self):
+    # Full: a partial index cannot answer lookups, free its memory
+    self.entries = []
+    self.texts = {}
+    self.complete = False
+
+  def _remove(self, question_id):
+    texts = self.texts.pop(question_id, None)
+    if texts is None:
+      return
+    for field in FIELDS:
+      for key in _keys(texts[field]):
+        position = bisect_left(self.entries, (key, question_id, field))
+        if position < len(self.entries) and self.entries[position] == (key, question_id, field):
+          del self.entries[position]
+
+  def build(self, rows):
+    """
+    Build the index from (id, question, answer) rows
+    sorting once is much faster than inserting one by one
+    """
+    entries = []
+    texts = {}
+    complete = True
+    for question_id, question, answer in rows:
+      row_entries = [(key, question_id, field)
+                     for field, text in zip(FIELDS, (question, answer))
+                     for key in _keys(text)]
+      if len(entries) + len(row_entries) > self.max_entries:
+        complete = False
+        break
+      entries.extend(row_entries)
+      texts[question_id] = {'question': question, 'answer': answer}
+    if complete:
+      entries.sort()
+    else:
+      entries, texts = [], {}
+    with self.lock:
+      self.entries = entries
+      self.texts = texts
+      self.complete = complete
+      self.built = True
+      self.built_at = time.monotonic()
+      # The rows may have been read before these changes
+      pending, self.pending = self.pending, None
+      for question_id, change in pending or []:
+        self._apply(question_id, change)
+
+  def expired(self):
+    """ The index was built more than ttl seconds ago """
+    return self.built and self.ttl is not None and time.monotonic() - self.built_at > self.ttl
+
+  def claim_rebuild(self):
+    """
+    Start recording the changes for a rebuild
+
+    Returns:
+    -------
+    claimed: bool
+      False if another rebuild is already running
+    """
+    with self.lock:
+      if self.pending is not None:
+        return False
+      self.pending = []
+      return True
+
+  def cancel_rebuild(self):
+    """ Give up a claimed rebuild, the next one is tried after ttl seconds """
+    with self.lock:
+      self.pending = None
+      self.built_at = time.monotonic()
+
+  def _apply(self, question_id, texts):
+    # Called with the lock, texts is (question, answer) or None for a deleted question
+    if texts is None:
+      self._remove(question_id)
+    elif self.complete:
+      self._remove(question_id)
+      self._add(question_id, *texts)
+
+  def _change(self, question_id, texts):
+    with self.lock:
+      self._apply(question_id, texts)
+      if self.pending is not None:
+        self.pending.append((question_id, texts))
+
+  def insert(self, question_id, question, answer):
+    """ Index a new (or updated) question """
+    self._change(question_id, (question, answer))
+
+  def delete(self, question_id):
+    """ Remove a question from the index """
+    self._change(question_id, None)
+
+  def search(self, prefix, limit=10):
+    """
+    Find questions and answers with a word starting with prefix
+
+    Parameters:
+    ----------
+    prefix: str
+      the text typed so far
+    limit: int
+      the maximum number of suggestions
+
+    Returns:
+    -------
+    suggestions: list
+      list of dict with the question id, the matched field and its text
+    """
+    prefix = prefix.lower()
+    key = prefix[:KEY_LENGTH]
+    suggestions = []
+    seen = set()
+    with self.lock:
+      position = bisect_left(self.entries, (key,))
+      while position < len(self.entries) and len(suggestions) < limit:
+        entry_key, question_id, field = self.entries[position]
+        position += 1
+        if not entry_key.startswith(key):
+          break
+        if (question_id, field) in seen:
+          continue
+        text = self.texts[question_id][field]
+        # Keys are truncated, check longer prefixes on the full text
+        if len(prefix) > KEY_LENGTH and prefix not in text.lower():
+          continue
+        seen.add((question_id, field))
+        suggestions.append({'id': question_id, 'field': field, 'text': text})
+    return suggestions
+
+
+
+def get_index():
+  """
+  Get the prefix index of the app (or of the request's tenant),
+  build it on first use and rebuild it in the background once
+  expired (in an app or request context). A full index is not
+  rebuilt: it stays on the database fallback.
+
+  Returns:
+  -------
+  index: PrefixIndex
+  """
+  extensions = namespace()
+  if 'suggest_index' not in extensions:
+    extensions['suggest_index'] = PrefixIndex(current_app.config.get('SUGGEST_MAX_ENTRIES', MAX_ENTRIES),
+                                              current_app.config.get('QUESTION_CACHE_TTL', QUESTION_CACHE_TTL))
+  index = extensions['suggest_index']
+  if not index.built:
+    with index.build_lock:
+      if not index.built:
+        _build(index, current_app, db.session.query(Question.id, Question.question, Question.answer).all())
+  elif index.complete and index.expired() and index.claim_rebuild():
+    # The expired index keeps answering until the new one is built
+    index.rebuild_thread = threading.Thread(target=_rebuild,
+                                            args=(index, current_app._get_current_object(), g.get('tenant_state')))
+    index.rebuild_thread.daemon = True
+    index.rebuild_thread.start()
+  return index
+
+
+
+def _build(index, app, rows):
+  index.build(rows)
+  if not index.complete:
+    app.logger.warning('Suggest index full (SUGGEST_MAX_ENTRIES=%d, %d questions): '
+                       'suggestions are served by ILIKE queries', index.max_entries, len(rows))
+
+
+
+def _rebuild(index, app, tenant_state):
+  """ Rebuild an expired index (background thread, same database as the request) """
+  with app.app_context():
+    if tenant_state is not None:
+      g.tenant_state = tenant_state
+    try:
+      rows = db.session.query(Question.id, Question.question, Question.answer).all()
+    except SQLAlchemyError:
+      app.logger.exception('Suggest index rebuild failed')
+      index.cancel_rebuild()
+      return
+    finally:
+      db.session.remove()
+    _build(index, app, rows)
+
+
+
+def _on_question_change(action, question):
+  """ Keep the index of the current app (or tenant) in sync with Question.insert()/delete() """
+  index = namespace().get('suggest_index')
+  if index is None or not index.built:
+    return
+  if action == 'insert':
+    index.insert(question.id, question.question, question.answer)
+  elif action == 'delete':
+    index.delete(question.id)
+
+
+question_listeners.append(_on_question_change)
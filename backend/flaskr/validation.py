@@ -0,0 +1,255 @@
+import re
+from functools import wraps
+from flask import request, abort, g
+
+
+'''
+Declarative request validation
+  Each endpoint describes the JSON body it expects as a dict of
+  field name -> Field. The schema is compiled once, when the route
+  is decorated, into a list of small checker functions held by the
+  route's wrapper, so a bad request is rejected with 400 before any
+  database work is done.
+'''
+
+# Integer strings: ASCII digits with an optional minus sign ('²' or '--3' are not)
+INTEGER_PATTERN = re.compile(r'^-?[0-9]+$')
+
+
+class Field(object):
+  """
+  Describe one field of a JSON request body
+
+  Parameters:
+  ----------
+  kind: type
+    expected python type (str, int, list or dict)
+  required: bool
+    the field must be present and not null
+  default:
+    value used when the field is missing (only if not required)
+  strip: bool
+    strip surrounding whitespace of str values
+  allow_empty: bool
+    accept an empty string (after strip) or an empty list
+  min_value, max_value: int
+    bounds of int values
+  max_length: int
+    maximum length of str or list values
+  items: type
+    type of each item of a list value (only int is supported)
+  schema: dict
+    nested schema of a dict value
+  choices: tuple
+    the accepted values
+  """
+  def __init__(self, kind, required=True, default=None, strip=True,
+               allow_empty=False, min_value=None, max_value=None,
+               max_length=None, items=None, schema=None, choices=None):
+    self.kind = kind
+    self.required = required
+    self.default = default
+    self.strip = strip
+    self.allow_empty = allow_empty
+    self.min_value = min_value
+    self.max_value = max_value
+    self.max_length = max_length
+    self.items = items
+    self.schema = schema
+    self.choices = choices
+
+
+
+def _to_int(value):
+  """
+  Convert value to int
+  accept int and numeric strings ('3') as sent by the frontend forms,
+  reject bool, float and any other string
+
+  Returns:
+  -------
+  (int, None) on success or (None, error message)
+  """
+  if isinstance(value, bool):
+    return None, 'must be an integer'
+  if isinstance(value, int):
+    return value, None
+  if isinstance(value, str) and INTEGER_PATTERN.match(value.strip()):
+    return int(value.strip()), None
+  return None, 'must be an integer'
+
+
+
+def _compile_field(name, field):
+  """
+  Compile a Field to a checker function
+
+  Returns:
+  -------
+  check: function
+    check(body, data, errors) reads `name` from body,
+    stores the clean value in data or a message in errors
+  """
+  checks = []
+
+  if field.kind is str:
+    def check_type(value):
+      if not isinstance(value, str):
+        return None, 'must be a string'
+      if field.strip:
+        value = value.strip()
+      if not field.allow_empty and value == '':
+        return None, 'must not be empty'
+      return value, None
+  elif field.kind is int:
+    check_type = _to_int
+  elif field.kind is list:
+    def check_type(value):
+      if not isinstance(value, list):
+        return None, 'must be a list'
+      if not field.allow_empty and len(value) == 0:
+        return None, 'must not be empty'
+      if field.items is int:
+        converted = []
+        for item in value:
+          item, message = _to_int(item)
+          if message:
+            return None, 'items must be integers'
+          converted.append(item)
+        value = converted
+      return value, None
+  elif field.kind is dict:
+    nested = compile_schema(field.schema or {})
+    def check_type(value):
+      if not isinstance(value, dict):
+        return None, 'must be an object'
+      value, nested_errors = nested(value)
+      if nested_errors:
+        return None, nested_errors
+      return value, None
+  else:
+    raise ValueError('Unsupported field type: {}'.format(field.kind))
+  checks.append(check_type)
+
+  if field.min_value is not None or field.max_value is not None:
+    def check_range(value):
+      if field.min_value is not None and value < field.min_value:
+        return None, 'must be at least {}'.format(field.min_value)
+      if field.max_value is not None and value > field.max_value:
+        return None, 'must be at most {}'.format(field.max_value)
+      return value, None
+    checks.append(check_range)
+
+  if field.max_length is not None:
+    def check_length(value):
+      if len(value) > field.max_length:
+        return None, 'must have at most {} items'.format(field.max_length) \
+          if isinstance(value, list) else 'must be at most {} characters'.format(field.max_length)
+      return value, None
+    checks.append(check_length)
+
+  if field.choices is not None:
+    def check_choices(value):
+      if value not in field.choices:
+        return None, 'must be one of {}'.format(', '.join(str(choice) for choice in field.choices))
+      return value, None
+    checks.append(check_choices)
+
+  def check(body, data, errors):
+    value = body.get(name)
+    if value is None:
+      if field.required:
+        errors[name] = 'is required'
+      else:
+        data[name] = field.default
+      return
+    for step in checks:
+      value, message = step(value)
+      if message:
+        errors[name] = message
+        return
+    data[name] = value
+
+  return check
+
+
+
+def compile_schema(schema):
+  """
+  Compile a schema (dict of name -> Field) to a validator
+
+  Returns:
+  -------
+  validate: function
+    validate(body) returns (data, errors), data is the clean body
+    and errors a dict of field name -> message (empty if valid)
+  """
+  checks = [_compile_field(name, field) for name, field in schema.items()]
+
+  def validate(body):
+    data = {}
+    errors = {}
+    for check in checks:
+      check(body, data, errors)
+    return data, errors
+
+  return validate
+
+
+
+def validate_json(schema):
+  """
+  Decorator to validate the JSON body of a route against schema
+
+  The schema is compiled when the route is decorated.
+  The clean body is stored in flask.g.body for the view.
+
+  Raises:
+  ------
+  400 error with field-level messages if the body is not a JSON
+  object or does not match the schema
+  """
+  def decorator(f):
+    # Compile once per route registration, not per request
+    validate = compile_schema(schema)
+
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+      body = request.get_json(silent=True)
+      if not isinstance(body, dict):
+        abort(400, description={'body': 'must be a JSON object'})
+      data, errors = validate(body)
+      if errors:
+        abort(400, description=errors)
+      g.body = data
+      return f(*args, **kwargs)
+
+    return wrapper
+  return decorator
+
+
+
+def validate_args(schema):
+  """
+  Decorator to validate the query string of a route against schema
+
+  Like validate_json, the values are strings converted by the
+  fields (e.g. Field(int)). The clean values are stored in flask.g.args.
+
+  Raises:
+  ------
+  400 error with field-level messages if the query string does not match the schema
+  """
+  def decorator(f):
+    validate = compile_schema(schema)
+
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+      data, errors = validate(request.args)
+      if errors:
+        abort(400, description=errors)
+      g.args = data
+      return f(*args, **kwargs)
+
+    return wrapper
+  return decorator
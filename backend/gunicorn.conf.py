@@ -0,0 +1,26 @@
+'''
+gunicorn configuration
+  gunicorn -c gunicorn.conf.py
+workers and threads come from WEB_CONCURRENCY and THREADS
+(see flaskr.serving.worker_config), BIND sets the address
+'''
+import os
+
+from flaskr.serving import worker_config, stagger
+
+
+_config = worker_config()
+
+wsgi_app = 'wsgi:app'
+bind = os.environ.get('BIND', '0.0.0.0:5000')
+workers = _config['workers']
+threads = _config['threads']
+worker_class = _config['worker_class']
+# Load (and warm) the app once in the parent, then fork the workers
+preload_app = True
+
+
+def post_fork(server, worker):
+  # The workers must not all reload their caches at the same moment
+  from wsgi import app
+  stagger(app)
@@ -1,12 +1,55 @@
 import os
-from sqlalchemy import Column, String, Integer, create_engine
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import Column, String, Integer, BigInteger, Index, Sequence, create_engine, text, func
+from sqlalchemy import orm
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 import json
 
 database_name = "trivia"
 database_path = "postgresql://{}:{}@{}/{}".format('postgres', 'passR00','localhost:5432', database_name)
 
-db = SQLAlchemy()
+'''
+bind_resolvers
+    functions returning the engine of the current request (e.g. the
+    tenant's database, see flaskr/tenancy.py) or None, the first engine
+    found is used by the session, the app's database otherwise
+'''
+bind_resolvers = []
+
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        for resolver in bind_resolvers:
+            engine = resolver()
+            if engine is not None:
+                return engine
+        return SignallingSession.get_bind(self, mapper, clause)
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+db = RoutingSQLAlchemy()
+
+'''
+question_listeners
+    functions called as listener(action, question) after a question
+    is committed by insert(), update() or delete() (e.g. to keep
+    in-memory indexes in sync), action is 'insert' or 'delete'
+'''
+question_listeners = []
+
+'''
+questions_version_seq
+    every insert, update and delete of a question takes the next
+    version (delete through a QuestionTombstone), GET /questions/changes
+    returns the rows with a version greater than the client's token.
+    Question writes hold an advisory lock until commit so versions are
+    committed in order and a token never skips a change.
+'''
+question_version_seq = Sequence('questions_version_seq')
+VERSION_LOCK_KEY = 7301
+
+def lock_versions():
+    db.session.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': VERSION_LOCK_KEY})
 
 '''
 setup_db(app)
@@ -25,12 +68,17 @@ Question
 '''
 class Question(db.Model):  
   __tablename__ = 'questions'
+  # Category listing is paged in SQL by id or difficulty (see trivia.psql)
+  __table_args__ = (
+    Index('ix_questions_category_id', 'category', 'id'),
+  )
 
   id = Column(Integer, primary_key=True)
   question = Column(String)
   answer = Column(String)
   category = Column(String)
   difficulty = Column(Integer)
+  version = Column(BigInteger, question_version_seq, server_default=question_version_seq.next_value(), nullable=False, index=True)
 
   def __init__(self, question, answer, category, difficulty):
     self.question = question
@@ -39,15 +87,27 @@ class Question(db.Model):
     self.difficulty = difficulty
 
   def insert(self):
+    lock_versions()
     db.session.add(self)
     db.session.commit()
+    self.notify('insert')
   
   def update(self):
+    lock_versions()
+    self.version = question_version_seq.next_value()
     db.session.commit()
+    self.notify('insert')
 
   def delete(self):
+    lock_versions()
     db.session.delete(self)
+    db.session.add(QuestionTombstone(self.id))
     db.session.commit()
+    self.notify('delete')
+
+  def notify(self, action):
+    for listener in question_listeners:
+      listener(action, self)
 
   def format(self):
     return {
@@ -58,6 +118,24 @@ class Question(db.Model):
       'difficulty': self.difficulty
     }
 
+# Questions without a difficulty are sorted (and paged) as UNRATED_DIFFICULTY
+UNRATED_DIFFICULTY = 0
+Index('ix_questions_category_sort_difficulty_id',
+      Question.category, func.coalesce(Question.difficulty, UNRATED_DIFFICULTY), Question.id)
+
+'''
+QuestionTombstone
+    a deleted question (for GET /questions/changes)
+'''
+class QuestionTombstone(db.Model):
+  __tablename__ = 'question_tombstones'
+
+  question_id = Column(Integer, primary_key=True)
+  version = Column(BigInteger, question_version_seq, server_default=question_version_seq.next_value(), nullable=False, index=True)
+
+  def __init__(self, question_id):
+    self.question_id = question_id
+
 '''
 Category
 
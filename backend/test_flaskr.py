@@ -1,10 +1,21 @@
 import os
+import time
 import unittest
 import json
+import tempfile
+from flask import Flask, jsonify, g
 from flask_sqlalchemy import SQLAlchemy
 
 from flaskr import create_app
-from models import setup_db, Question, Category
+from flaskr.serving import worker_config, stagger, MAX_WORKERS
+from flaskr.cache import TriviaCache
+from flaskr.suggest import PrefixIndex
+from flaskr.validation import Field, validate_json
+from flaskr.tenancy import TenantRegistry
+import numpy as np
+from flaskr.analytics import analyze, _candidate_pairs
+from sqlalchemy import create_engine, event, text
+from models import db, setup_db, Question, Category
 
 
 class TriviaTestCase(unittest.TestCase):
@@ -97,6 +108,77 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['categories'])
     
 
+    def test_retrieve_analytics(self):
+        """ Test for the analytics report of the question bank """
+        self.app.config['ANALYTICS_TOKEN'] = 'secret'
+        res = self.client().get('/analytics', headers={'X-Analytics-Token': 'secret'})
+        data = json.loads(res.data)
+        total = json.loads(self.client().get('/questions').data)['total_questions']
+
+        # status code = 200
+        self.assertEqual(res.status_code, 200)
+        # success = True
+        self.assertEqual(data['success'], True)
+        # check all the questions are counted
+        self.assertEqual(data['report']['total_questions'], total)
+        self.assertEqual(sum(data['report']['categories'].values()), total)
+
+
+    def test_analytics_stale_report_while_recomputed(self):
+        """ Test for the previous report served while another request recomputes it """
+        self.app.config['ANALYTICS_TOKEN'] = 'secret'
+        first = json.loads(self.client().get('/analytics', headers={'X-Analytics-Token': 'secret'}).data)
+        self.app.config['ANALYTICS_CACHE_SECONDS'] = 0
+        # another request holds the lock while it recomputes the report
+        with self.app.extensions['analytics_lock']:
+            res = self.client().get('/analytics', headers={'X-Analytics-Token': 'secret'})
+        data = json.loads(res.data)
+
+        # status code = 200
+        self.assertEqual(res.status_code, 200)
+        # check the previous report is returned without waiting
+        self.assertEqual(data['report'], first['report'])
+
+
+    def test_analytics_requires_token(self):
+        """ Test for 404 error without ANALYTICS_TOKEN and 401 error with a wrong token """
+        self.app.config['ANALYTICS_TOKEN'] = None
+        res = self.client().get('/analytics')
+
+        # status code = 404 (analytics not configured)
+        self.assertEqual(res.status_code, 404)
+
+        self.app.config['ANALYTICS_TOKEN'] = 'secret'
+        res = self.client().get('/analytics', headers={'X-Analytics-Token': 'wrong'})
+        data = json.loads(res.data)
+
+        # status code = 401
+        self.assertEqual(res.status_code, 401)
+        # success = False
+        self.assertEqual(data['success'], False)
+
+
+    def test_analytics_command(self):
+        """ Test for the analytics report printed by `flask analytics` """
+        result = self.app.test_cli_runner().invoke(args=['analytics', '--chunk-size', '5'])
+        report = json.loads(result.output)
+        total = json.loads(self.client().get('/questions').data)['total_questions']
+
+        # exit code = 0
+        self.assertEqual(result.exit_code, 0)
+        # check all the questions are counted (over several chunks)
+        self.assertEqual(report['total_questions'], total)
+        self.assertEqual(sum(report['categories'].values()), total)
+
+
+    def test_profiles_not_found_when_profiling_off(self):
+        """ Test for no admin endpoint when profiling is not configured """
+        res = self.client().get('/admin/profiles')
+
+        # status code = 404
+        self.assertEqual(res.status_code, 404)
+
+
     def test_404_sent_requesting_beyond_valid_page(self):
         """ Test for sending 404 error if requesting beyond valid page """
         res = self.client().get('/questions?page=1000')
@@ -133,17 +215,138 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(question, None)
         
 
-    def test_422_if_delete_question_fails(self):
-        """ Test for 422 error if the question not exist """
+    def test_404_if_delete_question_not_found(self):
+        """ Test for 404 error if the question not exist """
         res = self.client().delete('/questions/1000')
         data = json.loads(res.data)
 
-        # status code = 422
-        self.assertEqual(res.status_code, 422)
+        # status code = 404
+        self.assertEqual(res.status_code, 404)
         # success = False
         self.assertEqual(data['success'], False)
-        # message = 'Unprocessable'
-        self.assertEqual(data['message'], 'Unprocessable')
+        # massage = 'Resource Not Found'
+        self.assertEqual(data['message'], 'Resource Not Found')
+
+
+
+    '''
+    Test for the change feed
+    '''
+    def test_retrieve_question_changes(self):
+        """ Test for all questions as changes since token 0 """
+        res = self.client().get('/questions/changes?limit=5')
+        data = json.loads(res.data)
+
+        # status code = 200
+        self.assertEqual(res.status_code, 200)
+        # success = True
+        self.assertEqual(data['success'], True)
+        # check 5 changes ordered by version
+        versions = [change['version'] for change in data['changes']]
+        self.assertEqual(len(versions), 5)
+        self.assertEqual(versions, sorted(versions))
+        # check the next token is the last version
+        self.assertEqual(data['next'], str(versions[-1]))
+        self.assertEqual(data['has_more'], True)
+
+
+    def test_question_changes_since_token(self):
+        """ Test for only created and deleted questions since the token """
+        token = self.latest_change_token()
+        created = json.loads(self.client().post('/questions', json=self.new_question).data)['created']
+        res = self.client().get('/questions/changes?since={}'.format(token))
+        data = json.loads(res.data)
+
+        # status code = 200
+        self.assertEqual(res.status_code, 200)
+        # check the creation with the question
+        self.assertEqual([(change['id'], change['deleted']) for change in data['changes']], [(created, False)])
+        self.assertEqual(data['changes'][0]['question']['answer'], self.new_question['answer'])
+
+        self.client().delete('/questions/{}'.format(created))
+        data = json.loads(self.client().get('/questions/changes?since={}'.format(token)).data)
+        # check only the deletion is left (the question row is gone)
+        self.assertEqual([(change['id'], change['deleted']) for change in data['changes']], [(created, True)])
+        self.assertEqual(data['has_more'], False)
+        # check nothing changed since the next token
+        data = json.loads(self.client().get('/questions/changes?since={}'.format(data['next'])).data)
+        self.assertEqual(data['changes'], [])
+
+
+    def test_question_changes_not_skipped_by_concurrent_commit(self):
+        """ Test for changes committed while the feed is read returned by the next token """
+        removed = json.loads(self.client().post('/questions', json=self.new_question).data)['created']
+        token = self.latest_change_token()
+        other = create_engine(self.database_path)
+        committed = {}
+
+        def commit_changes(conn, cursor, statement, parameters, context, executemany):
+            # once the feed read (the first of its statements) is done,
+            # another worker creates a question then deletes one
+            if committed or 'version >' not in statement:
+                return
+            with other.begin() as connection:
+                committed['created'] = connection.execute(text(
+                    "INSERT INTO questions (question, answer, category, difficulty) "
+                    "VALUES ('Who painted the Mona Lisa?', 'Leonardo da Vinci', '2', 1) RETURNING id")).scalar()
+                connection.execute(text('DELETE FROM questions WHERE id = :id'), {'id': removed})
+                connection.execute(text('INSERT INTO question_tombstones (question_id) VALUES (:id)'), {'id': removed})
+
+        with self.app.app_context():
+            engine = db.get_engine(self.app)
+        event.listen(engine, 'after_cursor_execute', commit_changes)
+        try:
+            data = json.loads(self.client().get('/questions/changes?since={}'.format(token)).data)
+        finally:
+            event.remove(engine, 'after_cursor_execute', commit_changes)
+        changes = data['changes']
+        # follow the feed from the returned token
+        while True:
+            data = json.loads(self.client().get('/questions/changes?since={}'.format(data['next'])).data)
+            changes += data['changes']
+            if not data['has_more']:
+                break
+        self.client().delete('/questions/{}'.format(committed['created']))
+        other.dispose()
+
+        # check neither change is skipped
+        self.assertIn((committed['created'], False), [(change['id'], change['deleted']) for change in changes])
+        self.assertIn((removed, True), [(change['id'], change['deleted']) for change in changes])
+
+
+    def test_400_question_changes_token_not_valid(self):
+        """ Test for 400 error if the token is not valid """
+        res = self.client().get('/questions/changes?since=abc')
+        data = json.loads(res.data)
+
+        # status code = 400
+        self.assertEqual(res.status_code, 400)
+        # success = False
+        self.assertEqual(data['success'], False)
+        # field-level error for since
+        self.assertEqual(data['errors'], {'since': 'must be an integer'})
+
+
+    def test_400_question_changes_malformed_numbers(self):
+        """ Test for 400 error (not 500) if since or limit are malformed numbers """
+        for query in ['since=--5', 'since=-', 'limit=²', 'limit=１０']:
+            res = self.client().get('/questions/changes?' + query)
+            data = json.loads(res.data)
+
+            # status code = 400
+            self.assertEqual(res.status_code, 400)
+            # field-level error for the malformed field
+            self.assertEqual(list(data['errors'].values()), ['must be an integer'])
+
+
+    def latest_change_token(self):
+        """ Token of the last change (follow the feed until has_more is False) """
+        token = '0'
+        while True:
+            data = json.loads(self.client().get('/questions/changes?since={}&limit=1000'.format(token)).data)
+            token = data['next']
+            if not data['has_more']:
+                return token
 
 
 
@@ -164,17 +367,57 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(len(data['questions']))
 
 
-    def test_422_if_create_question_fails(self):
-        """ Test for 422 error if the question creation failed """
+    def test_create_question_updates_cached_counts(self):
+        """ Test for total questions and quiz ids cache reset after creating a question """
+        total = json.loads(self.client().get('/questions').data)['total_questions']
+        total_quizzes = json.loads(self.client().post('/quizzes', json=self.request_body_data).data)['total_quizzes']
+        data = json.loads(self.client().post('/questions', json=dict(self.new_question, category=2)).data)
+
+        # check total questions includes the created question
+        self.assertEqual(data['total_questions'], total + 1)
+        # check the created question can be played in its category
+        data = json.loads(self.client().post('/quizzes', json=self.request_body_data).data)
+        self.assertEqual(data['total_quizzes'], total_quizzes + 1)
+
+
+    def test_400_if_create_question_not_valid(self):
+        """ Test for 400 error if the question body is not valid """
         res = self.client().post('/questions', json=self.new_question_not_valid)
         data = json.loads(res.data)
 
-        # status code = 422
-        self.assertEqual(res.status_code, 422)
+        # status code = 400
+        self.assertEqual(res.status_code, 400)
         # success = False
         self.assertEqual(data['success'], False)
-        # message = 'Unprocessable'
-        self.assertEqual(data['message'], 'Unprocessable')
+        # message = 'Bad Request'
+        self.assertEqual(data['message'], 'Bad Request')
+        # field-level error for category
+        self.assertEqual(data['errors'], {'category': 'must be an integer'})
+
+
+    def test_400_if_create_question_category_malformed(self):
+        """ Test for 400 error if the category is a malformed numeric string """
+        res = self.client().post('/questions', json=dict(self.new_question, category='--3'))
+        data = json.loads(res.data)
+
+        # status code = 400
+        self.assertEqual(res.status_code, 400)
+        # field-level error for category
+        self.assertEqual(data['errors'], {'category': 'must be an integer'})
+
+
+    def test_400_if_create_question_empty(self):
+        """ Test for 400 error if question and answer are missing or empty """
+        res = self.client().post('/questions', json={'question': '   ', 'category': 3, 'difficulty': 2})
+        data = json.loads(res.data)
+
+        # status code = 400
+        self.assertEqual(res.status_code, 400)
+        # success = False
+        self.assertEqual(data['success'], False)
+        # field-level errors for question and answer
+        self.assertEqual(data['errors']['question'], 'must not be empty')
+        self.assertEqual(data['errors']['answer'], 'is required')
     
 
     def test_405_if_question_creation_not_allowed(self):
@@ -226,6 +469,118 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(len(data['questions']), 0)
 
 
+    def test_400_search_without_search_term(self):
+        """ Test for 400 error if searchTerm is missing """
+        res = self.client().post('/questions/search', json={})
+        data = json.loads(res.data)
+
+        # status code = 400
+        self.assertEqual(res.status_code, 400)
+        # success = False
+        self.assertEqual(data['success'], False)
+        # field-level error for searchTerm
+        self.assertEqual(data['errors'], {'searchTerm': 'is required'})
+
+
+    '''
+    Test for suggest questions while typing
+    '''
+    def test_suggest_questions(self):
+        """ Test for suggestions of questions with a word starting with the prefix """
+        res = self.client().get('/questions/suggest?q=tit')
+        data = json.loads(res.data)
+
+        # status code = 200
+        self.assertEqual(res.status_code, 200)
+        # success = True
+        self.assertEqual(data['success'], True)
+        # check there are suggestions
+        self.assertTrue(len(data['suggestions']))
+        # check each suggestion has a word starting with the prefix
+        for suggestion in data['suggestions']:
+            words = suggestion['text'].lower().split()
+            self.assertTrue(any(word.startswith('tit') for word in words))
+
+
+    def test_suggest_includes_created_question(self):
+        """ Test for the index updated when a question is created """
+        # build the index before creating the question
+        self.client().get('/questions/suggest?q=tallest')
+        created = json.loads(self.client().post('/questions', json=self.new_question).data)['created']
+        res = self.client().get('/questions/suggest?q=tallest&limit=20')
+        data = json.loads(res.data)
+
+        # status code = 200
+        self.assertEqual(res.status_code, 200)
+        # check the created question is suggested
+        self.assertIn(created, [suggestion['id'] for suggestion in data['suggestions']])
+
+
+    def test_suggest_index_rebuilt_after_ttl(self):
+        """ Test for a question created by another worker suggested once the index expired """
+        self.app.config['QUESTION_CACHE_TTL'] = 0
+        self.client().get('/questions/suggest?q=tallest')
+        # insert without the listeners, as another worker process would
+        with self.app.app_context():
+            question = Question('Which is the tallest waterfall?', 'Angel Falls', '3', 2)
+            Question.query.session.add(question)
+            Question.query.session.commit()
+            created = question.id
+        # starts the rebuild, the expired index answers meanwhile
+        self.client().get('/questions/suggest?q=tallest&limit=20')
+        self.app.extensions['suggest_index'].rebuild_thread.join()
+        res = self.client().get('/questions/suggest?q=tallest&limit=20')
+        data = json.loads(res.data)
+
+        # status code = 200
+        self.assertEqual(res.status_code, 200)
+        # check the question is suggested once rebuilt
+        self.assertIn(created, [suggestion['id'] for suggestion in data['suggestions']])
+
+
+    def test_suggest_falls_back_to_database_when_index_full(self):
+        """ Test for the same suggestions from the database when the index is full """
+        indexed = json.loads(self.client().get('/questions/suggest?q=tit').data)
+        self.app.config['SUGGEST_MAX_ENTRIES'] = 1
+        self.app.extensions.pop('suggest_index')
+        res = self.client().get('/questions/suggest?q=tit')
+        data = json.loads(res.data)
+
+        # status code = 200
+        self.assertEqual(res.status_code, 200)
+        # check the fallback is reported
+        self.assertEqual(indexed['indexed'], True)
+        self.assertEqual(data['indexed'], False)
+        # check the same questions are suggested
+        self.assertEqual(sorted((s['id'], s['field']) for s in data['suggestions']),
+                         sorted((s['id'], s['field']) for s in indexed['suggestions']))
+
+
+    def test_400_suggest_limit_not_valid(self):
+        """ Test for 400 error if the limit is out of range """
+        res = self.client().get('/questions/suggest?q=tit&limit=1000')
+        data = json.loads(res.data)
+
+        # status code = 400
+        self.assertEqual(res.status_code, 400)
+        # success = False
+        self.assertEqual(data['success'], False)
+        # field-level error for limit
+        self.assertIn('limit', data['errors'])
+
+
+    def test_400_suggest_limit_not_integer(self):
+        """ Test for 400 error (not the default limit) if the limit is not an integer """
+        res = self.client().get('/questions/suggest?q=tit&limit=abc')
+        data = json.loads(res.data)
+
+        # status code = 400
+        self.assertEqual(res.status_code, 400)
+        # field-level error for limit
+        self.assertEqual(data['errors'], {'limit': 'must be an integer'})
+
+
+
     '''
     Test for get questions by category's id
     '''
@@ -244,6 +599,97 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['total_questions_per_category'], 2)
 
 
+    def test_get_questions_by_category_sorted_by_difficulty(self):
+        """ Test for questions per category ordered by difficulty """
+        res = self.client().get('/categories/5/questions?sort=difficulty&order=desc')
+        data = json.loads(res.data)
+
+        # status code = 200
+        self.assertEqual(res.status_code, 200)
+        # check questions are ordered by difficulty (descending)
+        difficulties = [question['difficulty'] for question in data['questions']]
+        self.assertEqual(difficulties, sorted(difficulties, reverse=True))
+
+
+    def test_get_questions_by_category_random_with_seed(self):
+        """ Test for the same random order of questions per category with the same seed """
+        first = json.loads(self.client().get('/categories/5/questions?order=random&seed=42').data)
+        second = json.loads(self.client().get('/categories/5/questions?order=random&seed=42').data)
+        ordered = json.loads(self.client().get('/categories/5/questions').data)
+
+        # check the seed is returned
+        self.assertEqual(first['seed'], '42')
+        # check the order is repeatable
+        self.assertEqual([question['id'] for question in first['questions']],
+                         [question['id'] for question in second['questions']])
+        # check the same questions are returned
+        self.assertEqual(sorted(question['id'] for question in first['questions']),
+                         [question['id'] for question in ordered['questions']])
+
+
+    def test_get_questions_by_category_after_cursor(self):
+        """ Test for the page after a cursor continuing the same order """
+        ordered = json.loads(self.client().get('/categories/5/questions?sort=difficulty').data)['questions']
+        cursor = '{}:{}'.format(ordered[0]['difficulty'], ordered[0]['id'])
+        res = self.client().get('/categories/5/questions?sort=difficulty&after=' + cursor)
+        data = json.loads(res.data)
+
+        # status code = 200
+        self.assertEqual(res.status_code, 200)
+        # check the questions after the cursor are returned in the same order
+        self.assertEqual([question['id'] for question in data['questions']],
+                         [question['id'] for question in ordered[1:]])
+        # check there is no next page
+        self.assertIsNone(data['next'])
+
+
+    def test_questions_by_category_cursor_without_difficulty(self):
+        """ Test for a question without difficulty sorted and paged as difficulty 0 """
+        with self.app.app_context():
+            question = Question('Who discovered penicillin?', 'Alexander Fleming', '5', None)
+            Question.query.session.add(question)
+            Question.query.session.commit()
+            unrated = question.id
+        ordered = json.loads(self.client().get('/categories/5/questions?sort=difficulty').data)['questions']
+        res = self.client().get('/categories/5/questions?sort=difficulty&after=0:{}'.format(unrated))
+        data = json.loads(res.data)
+        with self.app.app_context():
+            Question.query.filter(Question.id == unrated).delete()
+            Question.query.session.commit()
+
+        # check the question without difficulty comes first
+        self.assertEqual(ordered[0]['id'], unrated)
+        # status code = 200
+        self.assertEqual(res.status_code, 200)
+        # check the questions after its cursor are the rated ones, in the same order
+        self.assertEqual([question['id'] for question in data['questions']],
+                         [question['id'] for question in ordered[1:]])
+
+
+    def test_400_questions_by_category_cursor_not_valid(self):
+        """ Test for 400 error if the cursor does not match the sort """
+        res = self.client().get('/categories/5/questions?sort=difficulty&after=12')
+        data = json.loads(res.data)
+
+        # status code = 400
+        self.assertEqual(res.status_code, 400)
+        # field-level error for after
+        self.assertEqual(data['errors'], {'after': 'is not a valid cursor'})
+
+
+    def test_400_questions_by_category_sort_not_valid(self):
+        """ Test for 400 error if sort is not id or difficulty """
+        res = self.client().get('/categories/5/questions?sort=answer')
+        data = json.loads(res.data)
+
+        # status code = 400
+        self.assertEqual(res.status_code, 400)
+        # success = False
+        self.assertEqual(data['success'], False)
+        # field-level error for sort
+        self.assertEqual(data['errors'], {'sort': 'must be one of id, difficulty'})
+
+
     def test_404_not_found_if_category_invalid(self):
         """ Test for 404 error if the category's id is invalid """
         res = self.client().get('/categories/3000/questions')
@@ -278,20 +724,321 @@ class TriviaTestCase(unittest.TestCase):
         self.assertNotEqual(data['question']['id'], 16)
 
 
-    def test_422_error_play_quiz_without_data(self):
-        """ Test for 422 error request with no data to play quiz """
+    def test_400_error_play_quiz_without_data(self):
+        """ Test for 400 error request with no data to play quiz """
         res = self.client().post('/quizzes', json={})
         data = json.loads(res.data)
 
-        # status code = 422
-        self.assertEqual(res.status_code, 422)
+        # status code = 400
+        self.assertEqual(res.status_code, 400)
         # success = False
         self.assertEqual(data['success'], False)
-        # message = 'Unprocessable'
-        self.assertEqual(data['message'], 'Unprocessable')
+        # message = 'Bad Request'
+        self.assertEqual(data['message'], 'Bad Request')
+        # both fields are required
+        self.assertEqual(data['errors'], {
+            'previous_questions': 'is required',
+            'quiz_category': 'is required'
+        })
 
     
 
+class ProfilingTestCase(unittest.TestCase):
+    """This class represents the on-demand profiling test case"""
+
+    def setUp(self):
+        """Define test variables and initialize app with profiling."""
+        self.profile_dir = tempfile.mkdtemp()
+        self.app = create_app({
+            'PROFILE_TOKEN': 'secret',
+            'PROFILE_DIR': self.profile_dir,
+            'PROFILE_KEEP': 2
+        })
+        self.client = self.app.test_client
+        self.database_path = "postgresql://{}:{}@{}/{}".format('postgres', 'passR00','localhost:5432', 'trivia_test')
+        setup_db(self.app, self.database_path)
+
+
+    def test_profile_request_on_demand(self):
+        """ Test for profile stored and listed with its SQL statements """
+        res = self.client().get('/categories', headers={'X-Profile': 'secret'})
+        name = res.headers['X-Profile-Name']
+        data = json.loads(self.client().get('/admin/profiles/' + name, headers={'X-Profile-Token': 'secret'}).data)
+
+        # status code = 200
+        self.assertEqual(res.status_code, 200)
+        # check the profile of the request
+        self.assertEqual(data['profile']['path'], '/categories')
+        # check the SQL statements are recorded with timings
+        self.assertTrue(data['profile']['sql_count'] >= 1)
+        self.assertIn('duration_ms', data['profile']['sql'][0])
+        # check the top functions
+        self.assertTrue(len(data['profile']['functions']))
+
+
+    def test_profiles_ring_buffer(self):
+        """ Test for only PROFILE_KEEP profiles kept and not profiled without the header """
+        for _ in range(3):
+            self.client().get('/categories', headers={'X-Profile': 'secret'})
+        res = self.client().get('/categories')
+        data = json.loads(self.client().get('/admin/profiles', headers={'X-Profile-Token': 'secret'}).data)
+
+        # check the request without header is not profiled
+        self.assertNotIn('X-Profile-Name', res.headers)
+        # check the 2 newest profiles are kept
+        self.assertEqual(len(data['profiles']), 2)
+
+
+    def test_401_profiles_without_token(self):
+        """ Test for 401 error if the admin token is wrong """
+        res = self.client().get('/admin/profiles', headers={'X-Profile-Token': 'wrong'})
+        data = json.loads(res.data)
+
+        # status code = 401
+        self.assertEqual(res.status_code, 401)
+        # success = False
+        self.assertEqual(data['success'], False)
+        # message = 'Unauthorized'
+        self.assertEqual(data['message'], 'Unauthorized')
+
+
+    def test_profiling_config_not_valid(self):
+        """ Test for ValueError if PROFILE_KEEP or PROFILE_SAMPLE_RATE is out of range """
+        with self.assertRaises(ValueError):
+            create_app({'PROFILE_TOKEN': 'secret', 'PROFILE_KEEP': 0})
+        with self.assertRaises(ValueError):
+            create_app({'PROFILE_SAMPLE_RATE': 1.5})
+        with self.assertRaises(ValueError):
+            create_app({'PROFILE_SAMPLE_RATE': -0.1})
+
+
+
+class TenancyTestCase(unittest.TestCase):
+    """This class represents the multi-tenant test case"""
+
+    def setUp(self):
+        """Define test variables and initialize app with tenants (tenant 'test' is the trivia_test database)."""
+        self.database_path = "postgresql://{}:{}@{}/{}".format('postgres', 'passR00','localhost:5432', 'trivia_test')
+        self.app = create_app({
+            'TENANT_DATABASE_PATH': self.database_path.replace('trivia_test', 'trivia_{tenant}'),
+            'TENANTS': 'test,other'
+        })
+        self.client = self.app.test_client
+        setup_db(self.app, self.database_path)
+
+
+    def test_request_routed_to_tenant(self):
+        """ Test for request with X-Tenant header using the tenant's pool and caches """
+        res = self.client().get('/categories', headers={'X-Tenant': 'test'})
+        data = json.loads(res.data)
+        registry = self.app.extensions['tenants']
+
+        # status code = 200
+        self.assertEqual(res.status_code, 200)
+        # success = True
+        self.assertEqual(data['success'], True)
+        # check the tenant is active and has its own cache
+        self.assertEqual(registry.active(), ['test'])
+        self.assertIn('trivia_cache', registry.get('test').extensions)
+        self.assertNotIn('trivia_cache', self.app.extensions)
+
+
+    def test_400_tenant_not_valid(self):
+        """ Test for 400 error if the tenant name is not valid """
+        res = self.client().get('/categories', headers={'X-Tenant': '../trivia'})
+        data = json.loads(res.data)
+
+        # status code = 400
+        self.assertEqual(res.status_code, 400)
+        # field-level error for tenant
+        self.assertIn('tenant', data['errors'])
+
+
+    def test_404_tenant_not_allowed(self):
+        """ Test for 404 error if the tenant is not in TENANTS """
+        res = self.client().get('/categories', headers={'X-Tenant': 'unknown'})
+        data = json.loads(res.data)
+
+        # status code = 404
+        self.assertEqual(res.status_code, 404)
+        # success = False
+        self.assertEqual(data['success'], False)
+
+
+    def test_least_recently_used_tenants_evicted(self):
+        """ Test for at most max_tenants active, the least recently used evicted """
+        registry = TenantRegistry('sqlite://', max_tenants=2, create_tables=False, engine_options={})
+        for tenant in ['a', 'b', 'a', 'c']:
+            registry.get(tenant)
+
+        # check 'b' (least recently used) is evicted
+        self.assertEqual(registry.active(), ['a', 'c'])
+
+
+    def test_idle_tenants_evicted_with_stable_tenants(self):
+        """ Test for idle tenants evicted when only active tenants are requested """
+        registry = TenantRegistry('sqlite://', idle_seconds=0.05, create_tables=False, engine_options={})
+        registry.get('a')
+        registry.get('b')
+        time.sleep(0.1)
+        registry.get('b')
+
+        # check 'a' (idle) is evicted although no tenant was activated
+        self.assertEqual(registry.active(), ['b'])
+
+
+    def test_404_tenant_database_not_available(self):
+        """ Test for 404 error (not 500) if the tenant's database does not exist """
+        res = self.client().get('/categories', headers={'X-Tenant': 'other'})
+        data = json.loads(res.data)
+
+        # status code = 404
+        self.assertEqual(res.status_code, 404)
+        # success = False
+        self.assertEqual(data['success'], False)
+        # check the tenant is not active
+        self.assertNotIn('other', self.app.extensions['tenants'].active())
+
+
+    def test_tenants_required_with_tenant_database_path(self):
+        """ Test for ValueError if tenant routing is on without TENANTS """
+        with self.assertRaises(ValueError):
+            create_app({'TENANT_DATABASE_PATH': self.database_path.replace('trivia_test', 'trivia_{tenant}')})
+
+
+
+class AnalyticsTestCase(unittest.TestCase):
+    """This class represents the analytics report test case"""
+
+    def setUp(self):
+        """Define rows (id, category, difficulty, question, answer) in two chunks."""
+        self.rows = [
+            (1, 4, 2, "Whose autobiography is entitled 'I Know Why the Caged Bird Sings'?", 'Maya Angelou'),
+            (2, 4, 2, "Whose autobiography is entitled 'I know why the caged bird sings'", 'Maya Angelou'),
+            (3, 1, 4, 'What is the heaviest organ in the human body?', 'The Liver'),
+            (4, 1, 3, 'Who discovered penicillin?', 'Alexander Fleming'),
+            (5, 4, 1, "What boxer's original name is Cassius Clay?", 'Muhammad Ali')
+        ]
+        self.texts = {row[0]: row[3] for row in self.rows}
+        self.report = analyze([self.rows[:2], self.rows[2:]], lambda ids: {i: self.texts[i] for i in ids})
+
+
+    def test_distributions(self):
+        """ Test for questions per category, difficulty and both """
+        self.assertEqual(self.report['total_questions'], 5)
+        self.assertEqual(self.report['categories'], {'1': 2, '4': 3})
+        self.assertEqual(self.report['difficulties'], {'1': 1, '2': 2, '3': 1, '4': 1})
+        self.assertIn({'category': 4, 'difficulty': 2, 'count': 2}, self.report['category_difficulties'])
+
+
+    def test_length_stats(self):
+        """ Test for question length stats """
+        lengths = sorted(len(row[3]) for row in self.rows)
+
+        self.assertEqual(self.report['question_length']['min'], lengths[0])
+        self.assertEqual(self.report['question_length']['max'], lengths[-1])
+        self.assertEqual(self.report['question_length']['median'], lengths[2])
+
+
+    def test_near_duplicates(self):
+        """ Test for near-duplicate questions (case and punctuation differ) """
+        self.assertEqual([duplicate['ids'] for duplicate in self.report['duplicates']], [[1, 2]])
+
+
+    def test_candidate_pairs_of_a_bucket(self):
+        """ Test for all the pairs of ids with the same band key, not only neighbours """
+        pairs = _candidate_pairs([[np.array([5, 5, 5, 7], dtype=np.uint64)]], np.array([10, 11, 12, 13]), 100)
+
+        self.assertEqual(sorted(pairs), [(10, 11), (10, 12), (11, 12)])
+
+
+    def test_category_not_numeric(self):
+        """ Test for categories stored as non-numeric strings counted by name """
+        rows = [(6, 'Science', 1, 'What is the speed of light?', '299792 km/s'), (7, None, 2, 'Who?', 'Nobody')]
+        report = analyze([self.rows, rows], lambda ids: {})
+
+        self.assertEqual(report['categories'], {'-1': 1, '1': 2, '4': 3, 'Science': 1})
+        self.assertIn({'category': 'Science', 'difficulty': 1, 'count': 1}, report['category_difficulties'])
+
+
+
+class ValidationTestCase(unittest.TestCase):
+    """This class represents the request validation test case"""
+
+    def create_view(self, app, rule, schema):
+        """ Register a view named `view` validated by schema """
+        @validate_json(schema)
+        def view():
+            return jsonify({'success': True, 'body': g.body})
+        app.add_url_rule(rule, 'view' + rule, view, methods=['POST'])
+
+
+    def test_views_with_the_same_name_use_their_schema(self):
+        """ Test for each decorated view validated by its own schema """
+        app = Flask(__name__)
+        self.create_view(app, '/first', {'name': Field(str)})
+        self.create_view(app, '/second', {'count': Field(int)})
+        client = app.test_client()
+
+        # check each route only requires the fields of its schema
+        self.assertEqual(client.post('/first', json={'name': 'trivia'}).status_code, 200)
+        self.assertEqual(client.post('/second', json={'count': '3'}).status_code, 200)
+        self.assertEqual(client.post('/second', json={'name': 'trivia'}).status_code, 400)
+
+
+
+class WorkerConfigTestCase(unittest.TestCase):
+    """This class represents the worker-count/thread config test case"""
+
+    def test_default_worker_config(self):
+        """ Test for default workers (2 * cores + 1) and threads """
+        config = worker_config({}, cpu_count=2)
+
+        self.assertEqual(config['workers'], 5)
+        self.assertEqual(config['threads'], 1)
+        self.assertEqual(config['worker_class'], 'sync')
+
+
+    def test_default_workers_bounded(self):
+        """ Test for default workers at most MAX_WORKERS on large machines """
+        config = worker_config({}, cpu_count=64)
+
+        self.assertEqual(config['workers'], MAX_WORKERS)
+
+
+    def test_worker_config_from_environment(self):
+        """ Test for WEB_CONCURRENCY and THREADS environment variables """
+        config = worker_config({'WEB_CONCURRENCY': '3', 'THREADS': '4'}, cpu_count=2)
+
+        self.assertEqual(config['workers'], 3)
+        self.assertEqual(config['threads'], 4)
+        # more than 1 thread uses the threaded worker
+        self.assertEqual(config['worker_class'], 'gthread')
+
+
+    def test_worker_config_not_valid(self):
+        """ Test for ValueError if workers or threads are not positive integers """
+        with self.assertRaises(ValueError):
+            worker_config({'WEB_CONCURRENCY': 'many'})
+        with self.assertRaises(ValueError):
+            worker_config({'THREADS': '0'})
+
+
+    def test_stagger_spreads_cache_expiry(self):
+        """ Test for the forked caches aged by a random part of their ttl """
+        app = Flask(__name__)
+        app.extensions['trivia_cache'] = TriviaCache(60)
+        app.extensions['suggest_index'] = index = PrefixIndex(ttl=60)
+        index.build([(1, 'Whose autobiography is entitled?', 'Maya Angelou')])
+        before = time.monotonic()
+        stagger(app)
+
+        # each worker gets its own load time within the last ttl seconds
+        self.assertTrue(before - 60 <= app.extensions['trivia_cache'].loaded_at <= time.monotonic())
+        self.assertTrue(before - 60 <= index.built_at <= time.monotonic())
+
+
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,10 @@
+'''
+WSGI entry point for production
+  gunicorn -c gunicorn.conf.py
+the app is created and warmed here, in the parent process, before
+gunicorn forks the workers (see flaskr/serving.py)
+'''
+from flaskr import create_app
+from flaskr.serving import preload
+
+app = preload(create_app())
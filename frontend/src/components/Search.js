@@ -1,8 +1,10 @@
 import React, { Component } from 'react'
+import $ from 'jquery';
 
 class Search extends Component {
   state = {
     query: '',
+    suggestions: []
   }
 
   getInfo = (event) => {
@@ -14,6 +16,30 @@ class Search extends Component {
     this.setState({
       query: this.search.value
     })
+    this.getSuggestions(this.search.value)
+  }
+
+  // Suggest questions and answers while typing
+  getSuggestions = (query) => {
+    if (query.trim() === '') {
+      this.setState({ suggestions: [] })
+      return;
+    }
+    $.ajax({
+      url: `/questions/suggest?q=${encodeURIComponent(query)}`,
+      type: "GET",
+      success: (result) => {
+        // Ignore late responses of a previous query
+        if (query === this.state.query) {
+          this.setState({ suggestions: result.suggestions })
+        }
+        return;
+      },
+      error: (error) => {
+        this.setState({ suggestions: [] })
+        return;
+      }
+    })
   }
 
   render() {
@@ -23,7 +49,13 @@ class Search extends Component {
           placeholder="Search questions..."
           ref={input => this.search = input}
           onChange={this.handleInputChange}
+          list="search-suggestions"
         />
+        <datalist id="search-suggestions">
+          {this.state.suggestions.map((suggestion) => (
+            <option key={`${suggestion.field}-${suggestion.id}`} value={suggestion.text} />
+          ))}
+        </datalist>
         <input type="submit" value="Submit" className="button"/>
       </form>
     )